@@ -19,7 +19,7 @@
 //////////////////////////////////////////
 
 var CGI_URL = "http://" + location.hostname + "/cgi-bin/wiggleCGI.py?";
-var attribute_values_file = "datasets.attribs.json";
+var attribute_values_file = CGI_URL + "attributes=1";
 var assembly = "GRCh37";
 
 //////////////////////////////////////////
@@ -224,11 +224,25 @@ function panel_reduction(panel) {
 // Computing panel selection count
 //////////////////////////////////////////
 
+function update_multiselect_counts(multiselect, counts) {
+  multiselect.find("option").each(function(rank, option) {
+    var value = $(option).attr("value");
+    var count = (counts !== undefined && value in counts) ? counts[value] : 0;
+    $(option).attr("label", value + " (" + count + ")");
+  });
+  multiselect.multiselect('rebuild');
+}
+
 function update_panel_count(panel) {
-  url = CGI_URL + "count=true&assembly=" + assembly + "&" + panel_query(panel);
+  // Total count, and count of each value of each attribute given the other constraints
+  url = CGI_URL + "facets=true&assembly=" + assembly + "&" + panel_query(panel);
   $.getJSON(url).done(
    function(data, textStatus, jqXHR) {
      panel.find("#count").text("(" + data["count"] + " elements selected)");
+     panel.find("select.multiselect").each(function(rank, multiselect) {
+       var attribute = $(multiselect).attr("attribute").replace(/^._/, "");
+       update_multiselect_counts($(multiselect), data["facets"][attribute]);
+     });
    }
   ).fail(catch_JSON_error);
 }
@@ -376,13 +390,102 @@ function update_my_panel() {
   $(this).removeClass('active');
 }
 
+// Colours of the plotted columns
+var plot_colours = ["#337ab7", "#d9534f", "#5cb85c", "#f0ad4e", "#5bc0de", "#777777"];
+
+function numeric_columns(rows) {
+  var columns = [];
+  for (var column = 0; column < rows[0].length; column++) {
+    if (rows.every(function(row) {return typeof row[column] == "number";})) {
+      columns.push(column);
+    }
+  }
+  return columns;
+}
+
+// Draws the numeric columns of a plot's data as lines, against the first one if there are several
+function draw_plot(canvas, data) {
+  var rows = data["rows"];
+  if (rows.length == 0) {
+    return false;
+  }
+  var columns = numeric_columns(rows);
+  if (columns.length == 0) {
+    return false;
+  }
+  var x = function(row, index) {return index;};
+  if (columns.length > 1) {
+    var x_column = columns.shift();
+    x = function(row, index) {return row[x_column];};
+  }
+
+  var xs = rows.map(x);
+  var ys = [].concat.apply([], rows.map(function(row) {return columns.map(function(column) {return row[column];});}));
+  var x_min = Math.min.apply(null, xs), x_max = Math.max.apply(null, xs);
+  var y_min = Math.min(0, Math.min.apply(null, ys)), y_max = Math.max.apply(null, ys);
+  var margin = 40;
+  var scale_x = function(value) {return margin + (canvas.width - 2 * margin) * (value - x_min) / ((x_max - x_min) || 1);};
+  var scale_y = function(value) {return canvas.height - margin - (canvas.height - 2 * margin) * (value - y_min) / ((y_max - y_min) || 1);};
+
+  var context = canvas.getContext("2d");
+  context.clearRect(0, 0, canvas.width, canvas.height);
+  context.strokeStyle = "#000000";
+  context.beginPath();
+  context.moveTo(margin, margin);
+  context.lineTo(margin, canvas.height - margin);
+  context.lineTo(canvas.width - margin, canvas.height - margin);
+  context.stroke();
+  context.fillStyle = "#000000";
+  context.fillText(x_min.toPrecision(3), margin, canvas.height - margin + 15);
+  context.fillText(x_max.toPrecision(3), canvas.width - margin - 20, canvas.height - margin + 15);
+  context.fillText(y_max.toPrecision(3), 2, margin);
+
+  var labels = data["labels"] || [];
+  columns.forEach(function(column, index) {
+    context.strokeStyle = plot_colours[index % plot_colours.length];
+    context.beginPath();
+    rows.forEach(function(row, row_index) {
+      if (row_index == 0) {
+        context.moveTo(scale_x(xs[row_index]), scale_y(row[column]));
+      } else {
+        context.lineTo(scale_x(xs[row_index]), scale_y(row[column]));
+      }
+    });
+    context.stroke();
+    if (index < labels.length) {
+      context.fillStyle = context.strokeStyle;
+      context.fillText(labels[index], canvas.width - margin - 80, margin + 15 * index);
+    }
+  });
+  return true;
+}
+
+// Plots are drawn here from their data, the image rendered by the server is a fallback
+function show_plot(modal, result) {
+  var show_image = function() {
+    // Results without an image are only available as data
+    if (result['view']) {
+      modal.find('img').attr('src',result['view']).show();
+    }
+  };
+  $.getJSON(CGI_URL + "plot=" + result["ID"]).done(function(data) {
+    if (data["status"] == "DONE" && draw_plot(modal.find('canvas')[0], data)) {
+      modal.find('canvas').show();
+    } else {
+      show_image();
+    }
+  }).fail(show_image);
+}
+
 function report_result(data) {
   if (data["status"] == "DONE") {
     if (data['url'].substr(-4,4) == ".txt") {
       var modal = $('#Image_modal').clone();
       modal.find('#url').attr('href',data['url']);
-      modal.find('img').attr('src',data['view']);
-      modal.find('#photo_url').attr('href',data['view']);
+      if (data['view']) {
+        modal.find('#photo_url').attr('href',data['view']);
+      }
+      show_plot(modal, data);
       modal.modal();
     } else {
       var modal = $('#Success_modal').clone();
@@ -394,22 +497,50 @@ function report_result(data) {
     $('#Empty_modal').modal();	
   } else if (data["status"] == "INVALID") {
     $('#Invalid_modal').modal();	
+  } else if (data["status"] == "REJECTED") {
+    $('#Rejected_modal').modal();	
   } else if (data["status"] == "ERROR") {
     $('#Failure_modal').modal();	
   } else if (data["status"] == "UNKNOWN") {
     $('#Unknown_modal').modal();	
-  } else if (data['status'] == "LAUNCHED") {
+  } else if (data['status'] == "LAUNCHED" || data['status'] == "QUEUED") {
     var modal = $("#JobSent_modal").clone();
     modal.find("#job_id").text(data["ID"]);
     modal.modal();
+    watch_job(data["ID"], data['status'] == "QUEUED" ? "QUEUED" : "WAITING");
   } else {
     $('#Waiting_modal').modal();	
+    watch_job(data["ID"], "WAITING");
   }
 }
 
+// The server holds each request until the job's status changes, then the result is shown.
+// Failed requests (e.g. timed out by a proxy) are sent again after a growing delay.
+function watch_job(jobID, status, delay) {
+  $.getJSON(CGI_URL + "wait=" + jobID + "&status=" + status).done(function(data) {
+    if (data["status"] == status) {
+      watch_job(jobID, status);
+    } else {
+      $('.modal').modal('hide');
+      report_result(data);
+    }
+  }).fail(function() {
+    var next = Math.min(2 * (delay || 1000), 60000);
+    setTimeout(function() {
+      watch_job(jobID, status, next);
+    }, next);
+  });
+}
+
 // Get result
 function get_result() {
-  $.getJSON(CGI_URL + "result=" + $('#result_box').val()).done(report_result).fail(catch_JSON_error);
+  var jobID = $('#result_box').val();
+  $.getJSON(CGI_URL + "result=" + jobID).done(function(data) {
+    if (!("ID" in data)) {
+      data["ID"] = jobID;
+    }
+    report_result(data);
+  }).fail(catch_JSON_error);
 }
 
 // Send job to server 
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+# Copyright [1999-2016] EMBL-European Bioinformatics Institute
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import wiggledb.wiggleDB
+import wiggledb.wiggleDB_storage
+class DatasetUpdateTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.datasets = os.path.join(self.directory, 'datasets.tsv')
+		self.write_datasets(['00', '01', '02', '03', '04'])
+
+		self.conn = wiggledb.wiggleDB_storage.connect(os.path.join(self.directory, 'database.sqlite3'))
+		self.cursor = self.conn.cursor()
+		wiggledb.wiggleDB.create_database(self.cursor, self.datasets)
+		self.conn.commit()
+
+	def tearDown(self):
+		self.conn.close()
+		shutil.rmtree(self.directory)
+
+	def write_datasets(self, cells):
+		datasets = open(self.datasets, 'w')
+		datasets.write('location\tname\ttype\tannotation\tassembly\tcell\n')
+		for index, cell in enumerate(cells):
+			datasets.write('%s\tn%i\tsignal\tFALSE\tGRCh37\t%s\n' % (os.path.join(self.directory, 'f%i.bw' % index), index, cell))
+		datasets.close()
+
+	def catalog_version(self):
+		return self.cursor.execute('SELECT version FROM catalog_version').fetchone()[0]
+
+	def test_reload_unchanged_file(self):
+		version = self.catalog_version()
+		added, removed, updated = wiggledb.wiggleDB.update_dataset_table(self.cursor, self.datasets)
+		self.assertEqual((added, removed, updated), ([], [], []))
+		self.assertEqual(self.catalog_version(), version)
+
+	def test_reload_changed_row(self):
+		version = self.catalog_version()
+		self.write_datasets(['00', '01', '02', '3x', '04'])
+		added, removed, updated = wiggledb.wiggleDB.update_dataset_table(self.cursor, self.datasets)
+		self.assertEqual((added, removed, updated), ([], [], [os.path.join(self.directory, 'f3.bw')]))
+		self.assertEqual(self.catalog_version(), version + 1)
+
+if __name__ == '__main__':
+	unittest.main()
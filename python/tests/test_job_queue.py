@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+# Copyright [1999-2016] EMBL-European Bioinformatics Institute
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import wiggledb.wiggleDB
+import wiggledb.wiggleDB_storage
+
+class QueuedJobTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.work = os.path.join(self.directory, 'work')
+		os.mkdir(self.work)
+
+		datasets = open(os.path.join(self.directory, 'datasets.tsv'), 'w')
+		datasets.write('location\tname\ttype\tannotation\tassembly\tcell\n')
+		for index in range(4):
+			location = os.path.join(self.directory, 'f%i.bw' % index)
+			open(location, 'w').write('data')
+			datasets.write('%s\tn%i\tsignal\tFALSE\tGRCh37\tc%i\n' % (location, index, index % 2))
+		datasets.close()
+		open(os.path.join(self.directory, 'chrom.sizes'), 'w').write('chr1\t1000\n')
+
+		self.config = os.path.join(self.directory, 'wiggleDB.conf')
+		self.write_config(0)
+
+		self.db = os.path.join(self.directory, 'database.sqlite3')
+		self.conn = wiggledb.wiggleDB_storage.connect(self.db)
+		self.cursor = self.conn.cursor()
+		wiggledb.wiggleDB.create_database(self.cursor, os.path.join(self.directory, 'datasets.tsv'))
+		wiggledb.wiggleDB.load_assembly(self.cursor, 'GRCh37', os.path.join(self.directory, 'chrom.sizes'))
+		self.conn.commit()
+
+	def tearDown(self):
+		self.conn.close()
+		shutil.rmtree(self.directory)
+
+	def write_config(self, max_jobs):
+		config = open(self.config, 'w')
+		config.write('working_directory\t%s/\n' % self.work)
+		config.write('batch_system\tLOCAL\n')
+		config.write('max_jobs\t%i\n' % max_jobs)
+		config.close()
+
+	def request(self, args, a, b=None):
+		argv = sys.argv
+		sys.argv = ['wiggleDB.py', '--db', self.db, '--config', self.config, '-y', 'GRCh37', '-a', '-wa', 'mean'] + args
+		try:
+			options, config = wiggledb.wiggleDB.get_options()
+		finally:
+			sys.argv = argv
+		options.a = a
+		options.b = b
+		res = wiggledb.wiggleDB.request_compute(self.conn, self.cursor, options, config, config['batch_system'])
+		self.conn.commit()
+		return res
+
+	def test_request_sharing_queued_set(self):
+		first = self.request([], {'cell':['c0']})
+		self.assertEqual(first['status'], 'QUEUED')
+
+		# The shared set A is claimed by the queued job, which has no batch ID to depend upon yet
+		second = self.request(['-wb', 'mean', '-w', 'diff'], {'cell':['c0']}, {'cell':['c1']})
+		self.assertEqual(second['status'], 'QUEUED')
+		self.assertNotEqual(first['ID'], second['ID'])
+		# Its private copy of set A is in the cache, where eviction and invalidation find it
+		locations = set(os.path.normpath(X[0]) for X in self.cursor.execute('SELECT location FROM cache'))
+		results = [os.path.join(self.work, X) for X in os.listdir(self.work) if X.endswith('.bw')]
+		self.assertTrue(set(results) <= locations)
+
+		self.write_config(10)
+		config = wiggledb.wiggleDB.read_config_file(self.config)
+		wiggledb.wiggleDB.dispatch_queued_jobs(self.conn, self.cursor, config, config['batch_system'])
+		statuses = [X[0] for X in self.cursor.execute('SELECT status FROM jobs WHERE job_id IN (?, ?)', (first['ID'], second['ID']))]
+		self.assertEqual(statuses, ['LAUNCHED', 'LAUNCHED'])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -23,11 +23,27 @@ import tempfile
 import os
 import os.path
 import json
+import hashlib
+import time
+import binascii
+import copy
 
-import wiggletools.parallelWiggleTools
-import wiggletools.multiJob
+import wiggledb.wiggleDB_storage
+import wiggledb.wiggleDB_snapshot
 
 verbose = False
+# Seconds to wait for a concurrent request to submit a job this request attaches to
+SUBMISSION_WAIT = 30
+# Number of times a request retries after a concurrent request claimed the same results
+CLAIM_ATTEMPTS = 3
+# Number of times the local batch system reruns a failed task
+LOCAL_RETRIES = 2
+# Timestamps recorded in the jobs table as a job goes through its life, after submitted
+JOB_STAGES = ['launched', 'compute_finished', 'upload_started', 'uploaded', 'emailed']
+# Number of times the mailer tries to deliver a message
+MAIL_RETRIES = 6
+# Seconds before the first new delivery attempt, doubled each time
+MAIL_RETRY_DELAY = 60
 
 ###########################################
 ## Configuration file
@@ -58,15 +74,24 @@ def get_options():
 	parser.add_argument('--emails','-e',dest='emails',help='List of e-mail addresses for reminder',nargs='*')
 
 	parser.add_argument('--load','-l',dest='load',help='Datasets to load in database')
+	parser.add_argument('--update','-u',dest='update',help='Datasets to merge into an existing database, only changed rows are touched')
+	parser.add_argument('--upgrade',dest='upgrade',help='Bring an existing database up to the current schema', action='store_true')
 	parser.add_argument('--load_assembly','-la',dest='load_assembly',help='Assembly name and path to file with chromosome lengths',nargs=2)
 	parser.add_argument('--assembly','-y',dest='assembly',help='File with chromosome lengths')
 	parser.add_argument('--clean',dest='clean',help='Delete cached datasets older than X days', type=int)
+	parser.add_argument('--evict',dest='evict',help='Evict the least valuable cached results until the working directory fits in the cache_budget bytes of the configuration file, or the given budget (e.g. 500G)', nargs='?', const='config')
 	parser.add_argument('--cache',dest='cache',help='Dump cache info', action='store_true')
 	parser.add_argument('--datasets',dest='datasets',help='Print dataset info', action='store_true')
 	parser.add_argument('--clear_cache',dest='clear_cache',help='Reset cache info', nargs='*')
+	parser.add_argument('--invalidate',dest='invalidate',help='Remove the cached results computed from the given files, directly or through other cached results. Without files, from the datasets replaced or removed since. With --update, also from the datasets removed or updated by the update', nargs='*')
 	parser.add_argument('--remember',dest='remember',help='Preserve dataset from garbage collection', action='store_true')
-	parser.add_argument('--dry-run',dest='dry_run',help='Do not run the command, print wiggletools command', action='store_true')
+	parser.add_argument('--dry-run',dest='dry_run',help='Do not run the command, print the planned wiggletools commands, cache use and estimated cost', action='store_true')
+	parser.add_argument('--poll',dest='poll',help='Query the batch system once for all running jobs and record their status', action='store_true')
 	parser.add_argument('--result','-r',dest='result',help='Return status or end result of job', type=int)
+	parser.add_argument('--batch',dest='batch',help='JSON manifest of queries to submit together')
+	parser.add_argument('--batch_result',dest='batch_result',help='Return status or end result of the jobs of a batch', type=int)
+	parser.add_argument('--retry',dest='retry',help='Rerun the failed tasks of a job run by the local batch system', type=int)
+	parser.add_argument('--stats',dest='stats',help='Print job and cache statistics in Prometheus text format', action='store_true')
 	parser.add_argument('--attributes','-t',dest='attributes',help='Print JSON hash of attributes and values', action='store_true')
 	parser.add_argument('--verbose','-v',dest='verbose',help='Turn on status output',action='store_true')
 	parser.add_argument('--config','-c',dest='config',help='Configuration file')
@@ -74,7 +99,7 @@ def get_options():
 	parser.add_argument('--jobs','-j',dest='jobs',help='Print list of jobs',nargs='*')
 
 	options = parser.parse_args()
-	if all(X is None for X in [options.load, options.clean, options.result, options.load_assembly, options.datasets, options.clear_cache]) and not options.cache and not options.attributes and not options.annotations:
+	if all(X is None for X in [options.load, options.update, options.clean, options.evict, options.result, options.batch, options.batch_result, options.retry, options.load_assembly, options.datasets, options.clear_cache, options.invalidate]) and not options.cache and not options.attributes and not options.annotations and not options.upgrade and not options.poll and not options.stats:
 		assert options.a is not None, 'No dataset selection to run on'
 		assert options.wa is not None, 'No dataset transformation to run on'
 		assert options.assembly is not None, 'No assembly name specified'
@@ -105,7 +130,10 @@ def create_database(cursor, filename):
 		print 'Creating database'
 	create_assembly_table(cursor)
 	create_cache(cursor)
+	create_cache_key_index(cursor)
 	create_job_table(cursor)
+	create_local_tables(cursor)
+	create_outbox_table(cursor)
 	create_dataset_table(cursor, filename)
 
 def create_assembly_table(cursor):
@@ -130,6 +158,88 @@ def create_job_table(cursor):
 	status varchar(255)
 	)
 	''')
+	add_missing_columns(cursor, 'jobs', [('lsf_state', 'varchar(255)'), ('lsf_state2', 'varchar(255)'), ('return_values', 'varchar(1000)'), ('submitted', 'datetime'), ('finished', 'datetime')])
+	add_missing_columns(cursor, 'jobs', [(X, 'datetime') for X in JOB_STAGES] + [('input_bytes', 'int'), ('output_bytes', 'int')])
+	add_missing_columns(cursor, 'jobs', [('user', 'varchar(1000)'), ('cost', 'int'), ('job_batch', 'int')])
+	cursor.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)')
+
+	# Claimed jobs held back by admission control, with what is needed to submit them:
+	# the stages of commands, and the settings of each job submitted with the first one
+	cursor.execute('''
+	CREATE TABLE IF NOT EXISTS
+	job_queue
+	(
+	job_id int PRIMARY KEY,
+	deferred bit,
+	cmds text,
+	dependency int,
+	settings text
+	)
+	''')
+
+	# Jobs submitted together, with the result handle of each query
+	cursor.execute('''
+	CREATE TABLE IF NOT EXISTS
+	job_batches
+	(
+	job_batch INTEGER PRIMARY KEY AUTOINCREMENT,
+	submitted datetime,
+	user varchar(1000),
+	queries text
+	)
+	''')
+
+	# Cache outcome of every compute request
+	cursor.execute('''
+	CREATE TABLE IF NOT EXISTS
+	request_log
+	(
+	time datetime,
+	query_hash char(40),
+	job_id int,
+	outcome varchar(255)
+	)
+	''')
+
+	# Compact summary of jobs whose results were evicted
+	cursor.execute('''
+	CREATE TABLE IF NOT EXISTS
+	jobs_archive
+	(
+	job_id int,
+	status varchar(255),
+	submitted datetime,
+	finished datetime
+	)
+	''')
+
+def create_outbox_table(cursor):
+	# E-mails waiting to be delivered by wiggleDB_mailer.py, stage is recorded against the job once sent
+	cursor.execute('''
+	CREATE TABLE IF NOT EXISTS
+	outbox
+	(
+	message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+	job_id int,
+	stage varchar(255),
+	sender varchar(1000),
+	recipients varchar(1000),
+	message text,
+	status varchar(255),
+	attempts int DEFAULT 0,
+	created datetime,
+	next_attempt datetime,
+	sent datetime,
+	error varchar(1000)
+	)
+	''')
+	cursor.execute('CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, next_attempt)')
+
+def add_missing_columns(cursor, table, columns):
+	present = [X[1] for X in cursor.execute('PRAGMA table_info(%s)' % table).fetchall()]
+	for name, definition in columns:
+		if name not in present:
+			cursor.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, name, definition))
 
 def create_cache(cursor):
 	cursor.execute('''
@@ -144,11 +254,43 @@ def create_cache(cursor):
 	last_query datetime
 	)
 	''')
+	add_missing_columns(cursor, 'cache', [('query_hash', 'char(40)'), ('reduction', 'varchar(255)'), ('hits', 'int DEFAULT 0'), ('size', 'int')])
+	add_missing_columns(cursor, 'cache', [('plot', 'varchar(255)'), ('labels', 'varchar(10000)')])
+	cursor.execute('CREATE INDEX IF NOT EXISTS cache_job_id ON cache (job_id)')
 
-def create_dataset_table(cursor, filename):
+	# Files each cached result was computed from: datasets, with their identity when
+	# the result was claimed, and the cached results it reads (derived)
+	cursor.execute('''
+	CREATE TABLE IF NOT EXISTS
+	cache_inputs
+	(
+	query_hash char(40),
+	location varchar(1000)
+	)
+	''')
+	add_missing_columns(cursor, 'cache_inputs', [('identity', 'varchar(1000)'), ('derived', 'bit DEFAULT 0')])
+	cursor.execute('CREATE INDEX IF NOT EXISTS cache_inputs_query_hash ON cache_inputs (query_hash)')
+	cursor.execute('CREATE INDEX IF NOT EXISTS cache_inputs_location ON cache_inputs (location)')
+
+def create_cache_key_index(cursor):
+	cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS cache_query_hash ON cache (query_hash)')
+
+def open_dataset_file(filename):
 	file = open(filename)
 	items = file.readline().strip().split('\t')
 	assert items[:5] == list(('location','name','type','annotation','assembly')), "Badly formed dataset table, please ensure the first five columns refer to location, name, type, annotation and assembly"
+	return file, items
+
+def dataset_rows(file, width):
+	for line in file:
+		if len(line.strip()) == 0:
+			continue
+		row = line.strip().split('\t')
+		assert len(row) == width, 'Expected %i columns in dataset line:\n%s' % (width, line)
+		yield row
+
+def create_dataset_table(cursor, filename):
+	file, items = open_dataset_file(filename)
 	header = '''
 			CREATE TABLE IF NOT EXISTS 
 			datasets 
@@ -169,10 +311,146 @@ def create_dataset_table(cursor, filename):
 	column_names = [X[0] for X in cursor.description]
 	assert column_names == items, 'Mismatch between the expected columns: \n%s\nAnd the columns in file:\n%s' % ("\t".join(column_names), '\t'.join(items))
 
-	for line in file:
-		cursor.execute('INSERT INTO datasets VALUES (%s)' % ",".join("'%s'" % X for X in line.strip().split('\t')))
+	# Streamed through a single prepared statement, within one transaction
+	cursor.executemany('INSERT INTO datasets VALUES (%s)' % ",".join('?' for X in items), dataset_rows(file, len(items)))
 	file.close()
 
+	create_dataset_indexes(cursor)
+	refresh_catalog(cursor)
+
+def create_dataset_indexes(cursor):
+	# Selections are conjunctions of per-attribute disjunctions, always restricted to one assembly
+	cursor.execute('CREATE INDEX IF NOT EXISTS datasets_assembly ON datasets (assembly, annotation)')
+	cursor.execute('CREATE INDEX IF NOT EXISTS datasets_location ON datasets (location)')
+	for attribute in get_dataset_attributes_2(cursor):
+		if attribute not in ['location', 'assembly', 'annotation']:
+			cursor.execute('CREATE INDEX IF NOT EXISTS datasets_%s ON datasets (%s, assembly)' % (attribute, attribute))
+	cursor.execute('ANALYZE datasets')
+
+def create_catalog_tables(cursor):
+	# Materialised views of the datasets table, served as is to the GUI
+	cursor.execute('''
+	CREATE TABLE IF NOT EXISTS
+	attribute_values
+	(
+	attribute varchar(255),
+	value varchar(255)
+	)
+	''')
+	cursor.execute('''
+	CREATE TABLE IF NOT EXISTS
+	annotation_names
+	(
+	assembly varchar(100),
+	name varchar(100)
+	)
+	''')
+	cursor.execute('CREATE INDEX IF NOT EXISTS annotation_names_assembly ON annotation_names (assembly)')
+	# Number of datasets of each attribute value, the facets of a selection without constraints
+	cursor.execute('''
+	CREATE TABLE IF NOT EXISTS
+	facet_totals
+	(
+	assembly varchar(100),
+	attribute varchar(255),
+	value varchar(255),
+	count int
+	)
+	''')
+	cursor.execute('CREATE INDEX IF NOT EXISTS facet_totals_attribute ON facet_totals (assembly, attribute)')
+	# Single row, incremented each time the datasets change
+	cursor.execute('''
+	CREATE TABLE IF NOT EXISTS
+	catalog_version
+	(
+	version int,
+	modified datetime
+	)
+	''')
+	# Random, so that a rebuilt database, whose versions start again at 1, is told apart
+	add_missing_columns(cursor, 'catalog_version', [('catalog_id', 'char(16)')])
+
+def refresh_catalog(cursor):
+	create_catalog_tables(cursor)
+	cursor.execute('DELETE FROM attribute_values')
+	for attribute in get_dataset_attributes(cursor):
+		cursor.execute('INSERT INTO attribute_values (attribute, value) SELECT DISTINCT ?, %s FROM datasets' % attribute, (attribute,))
+	cursor.execute('DELETE FROM annotation_names')
+	cursor.execute('INSERT INTO annotation_names (assembly, name) SELECT assembly, name FROM datasets WHERE annotation')
+	cursor.execute('DELETE FROM facet_totals')
+	for attribute in get_facet_columns(cursor):
+		cursor.execute('INSERT INTO facet_totals (assembly, attribute, value, count) SELECT assembly, ?, %s, COUNT(*) FROM datasets GROUP BY assembly, %s' % (attribute, attribute), (attribute,))
+	catalog_id = binascii.hexlify(os.urandom(8))
+	if cursor.execute('UPDATE catalog_version SET version = version + 1, modified = datetime(\'now\'), catalog_id = COALESCE(catalog_id, ?)', (catalog_id,)).rowcount == 0:
+		cursor.execute('INSERT INTO catalog_version (version, modified, catalog_id) VALUES (1, datetime(\'now\'), ?)', (catalog_id,))
+
+def update_dataset_table(cursor, filename):
+	file, items = open_dataset_file(filename)
+	column_names = get_dataset_attributes_2(cursor)
+	assert column_names == items, 'Mismatch between the expected columns: \n%s\nAnd the columns in file:\n%s\nPlease reload the database from scratch' % ("\t".join(column_names), '\t'.join(items))
+
+	# The new rows go through a copy of the table, so that both sides are stored with the same
+	# column affinities (e.g. '00' in a numeric column is read back as 0)
+	cursor.execute('DROP TABLE IF EXISTS temp.datasets_update')
+	cursor.execute('CREATE TEMP TABLE datasets_update AS SELECT * FROM datasets WHERE 0')
+	cursor.executemany('INSERT INTO datasets_update VALUES (%s)' % ",".join('?' for X in items), dataset_rows(file, len(items)))
+	file.close()
+
+	previous = dict((X[0], X) for X in cursor.execute('SELECT * FROM datasets'))
+	added = []
+	updated = []
+	for row in cursor.execute('SELECT * FROM datasets_update').fetchall():
+		old_row = previous.pop(row[0], None)
+		if old_row is None:
+			added.append(row)
+		elif old_row != row:
+			updated.append(row[1:] + row[:1])
+	cursor.execute('DROP TABLE temp.datasets_update')
+	removed = [[X] for X in previous]
+
+	cursor.executemany('DELETE FROM datasets WHERE location = ?', removed)
+	cursor.executemany('UPDATE datasets SET %s WHERE location = ?' % ", ".join('%s = ?' % X for X in items[1:]), updated)
+	cursor.executemany('INSERT INTO datasets VALUES (%s)' % ",".join('?' for X in items), added)
+	if verbose:
+		print 'Added %i, removed %i and updated %i datasets' % (len(added), len(removed), len(updated))
+
+	create_dataset_indexes(cursor)
+	if len(added) + len(removed) + len(updated) > 0:
+		refresh_catalog(cursor)
+	return [X[0] for X in added], [X[0] for X in removed], [X[-1] for X in updated]
+
+def hash_cache_queries(cursor):
+	# Older databases only have the full text queries, the datasets they refer to are the
+	# words which are dataset locations
+	locations = set(X[0] for X in cursor.execute('SELECT location FROM datasets'))
+	rows = cursor.execute('SELECT rowid, query FROM cache WHERE query_hash IS NULL').fetchall()
+	cursor.executemany('UPDATE cache SET query_hash = ? WHERE rowid = ?', [(cache_key(query, [X for X in query.split(' ') if X in locations]), rowid) for rowid, query in rows])
+	# Later entries supersede earlier ones for the same query
+	cursor.execute('DELETE FROM cache WHERE rowid NOT IN (SELECT MAX(rowid) FROM cache GROUP BY query_hash)')
+	if verbose:
+		print 'Hashed %i cache entries' % len(rows)
+
+def set_journal_mode(conn, config):
+	# Only where the configuration asks for it: WAL is unsafe when finish jobs write
+	# to the database from cluster nodes over a network file system
+	if config is not None and 'journal_mode' in config:
+		mode = wiggledb.wiggleDB_storage.set_journal_mode(conn, config['journal_mode'])
+		if verbose:
+			print 'Journal mode: %s' % mode
+
+def upgrade_database(cursor):
+	if verbose:
+		print 'Upgrading database'
+	create_assembly_table(cursor)
+	create_cache(cursor)
+	hash_cache_queries(cursor)
+	create_cache_key_index(cursor)
+	create_job_table(cursor)
+	create_local_tables(cursor)
+	create_outbox_table(cursor)
+	create_dataset_indexes(cursor)
+	refresh_catalog(cursor)
+
 ###########################################
 ## Loading assembly info
 ###########################################
@@ -180,14 +458,22 @@ def create_dataset_table(cursor, filename):
 def load_assembly(cursor, assembly_name, chrom_sizes):
 	if verbose:
 		print 'Loading path to assembly chromosome length %s for %s' % (chrom_sizes, assembly_name)
-	cursor.execute('INSERT INTO assemblies VALUES(\'%s\',\'%s\')' % (assembly_name, chrom_sizes))
+	cursor.execute('INSERT INTO assemblies VALUES(?, ?)', (assembly_name, chrom_sizes))
 
 ###########################################
 ## Garbage cleaning 
 ###########################################
 
+def clean_temp_file(temp):
+	# Jobs run by the local batch system have no batch temporary files
+	if temp is not None:
+		import wiggletools.multiJob
+		wiggletools.multiJob.clean_temp_file(temp)
+
 def remove_job(cursor, job):
+	cursor.execute('DELETE FROM cache_inputs WHERE query_hash IN (SELECT query_hash FROM cache WHERE job_id = ?)', (job,))
 	cursor.execute('DELETE FROM cache WHERE job_id = ?', (job,))
+	cursor.execute('DELETE FROM job_queue WHERE job_id = ?', (job,))
 	cursor.execute('DELETE FROM jobs WHERE job_id = ?', (job,))
 
 def remove_jobs(cursor, jobs):
@@ -195,20 +481,201 @@ def remove_jobs(cursor, jobs):
 		remove_job(cursor, job)
 
 def clean_database(cursor, days):
-	for location in cursor.execute('SELECT location FROM cache WHERE julianday(\'now\') - julianday(last_query) > %i AND remember = 0' % days).fetchall():
+	for location in cursor.execute('SELECT location FROM cache WHERE julianday(\'now\') - julianday(last_query) > ? AND remember = 0', (days,)).fetchall():
 		if verbose:
 			print 'Removing %s' % location[0]
 		if os.path.exists(location[0]):
 			os.remove(location[0])
-	cursor.execute('DELETE FROM cache WHERE julianday(\'now\') - julianday(last_query) > %i AND remember = 0' % days)
+	cursor.execute('DELETE FROM cache WHERE julianday(\'now\') - julianday(last_query) > ? AND remember = 0', (days,))
 
-	for temp in cursor.execute('SELECT temp FROM jobs WHERE status="DONE" OR status="EMPTY"').fetchall():
+	for temp in cursor.execute('SELECT temp FROM jobs WHERE status=\'DONE\' OR status=\'EMPTY\'').fetchall():
 		if verbose:
 			print 'Removing %s and derived files' % temp[0]
-		multiJob.clean_temp_file(temp[0])
+		clean_temp_file(temp[0])
+
+	cursor.execute('DELETE FROM cache WHERE job_id IN (SELECT job_id FROM jobs WHERE status = \'ERROR\')')
+	cursor.execute('DELETE FROM jobs WHERE status = \'ERROR\'')
+
+	if cursor.execute('SELECT name FROM sqlite_master WHERE name = "shards"').fetchone() is not None:
+		clean_shards(cursor, days)
+	if cursor.execute('SELECT name FROM sqlite_master WHERE name = "outbox"').fetchone() is not None:
+		cursor.execute('DELETE FROM outbox WHERE status != \'QUEUED\' AND julianday(\'now\') - julianday(created) > ?', (days,))
+
+# Forgets all jobs, their cached results and the local tasks and shards computing them
+def clear_cache(cursor):
+	if cursor.execute('SELECT name FROM sqlite_master WHERE name = \'shards\'').fetchone() is not None:
+		# Shards being computed are only known to their tasks
+		for location in cursor.execute('SELECT location FROM shards UNION SELECT location FROM local_tasks WHERE location IS NOT NULL').fetchall():
+			if os.path.exists(location[0]):
+				os.remove(location[0])
+	for table in ['cache', 'cache_inputs', 'jobs', 'job_queue', 'job_batches', 'local_tasks', 'local_batches', 'shards']:
+		cursor.execute('DROP TABLE IF EXISTS %s' % table)
+	create_cache(cursor)
+	create_cache_key_index(cursor)
+	create_job_table(cursor)
+	create_local_tables(cursor)
+
+###########################################
+## Cache management
+###########################################
+
+# Entries queried or reused more recently than this are never evicted, as running jobs may read them
+EVICTION_GRACE_HOURS = 24
+# Number of cache results evicted per transaction
+EVICTION_BATCH = 50
 
-	cursor.execute('DELETE FROM cache WHERE job_id IN (SELECT job_id FROM jobs WHERE status = "ERROR")' % days)
-	cursor.execute('DELETE FROM jobs WHERE status = "ERROR"' % days)
+def parse_size(string):
+	units = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+	if string[-1].upper() in units:
+		return int(float(string[:-1]) * units[string[-1].upper()])
+	else:
+		return int(string)
+
+def directory_size(directory):
+	total = 0
+	for root, dirs, files in os.walk(directory):
+		for name in files:
+			path = os.path.join(root, name)
+			if os.path.isfile(path):
+				total += os.path.getsize(path)
+	return total
+
+def result_files(location):
+	return [X for X in [location, location + '.png', location + '.empty'] if os.path.exists(X)]
+
+def eviction_candidates(cursor):
+	# One line per result file, with its accumulated hits and the time taken to compute it
+	reports = cursor.execute('''
+		SELECT 
+			cache.location, 
+			SUM(COALESCE(cache.hits, 0)), 
+			MAX(cache.size), 
+			MAX((julianday(jobs.finished) - julianday(jobs.submitted)) * 86400), 
+			MIN(julianday('now') - julianday(cache.last_query)),
+			MAX(jobs.status = \'ERROR\')
+		FROM cache JOIN jobs USING (job_id) 
+		WHERE jobs.status IN (\'DONE\', \'EMPTY\', \'ERROR\') 
+		AND cache.location IS NOT NULL 
+		GROUP BY cache.location 
+		HAVING MAX(cache.remember) = 0 
+		AND MIN(julianday('now') - julianday(cache.last_query)) * 24 > ?
+		''', (EVICTION_GRACE_HOURS,)).fetchall()
+
+	candidates = []
+	for location, hits, size, compute_time, age, failed in reports:
+		if size is None:
+			size = sum(os.path.getsize(X) for X in result_files(location))
+			cursor.execute('UPDATE cache SET size = ? WHERE location = ?', (size, location))
+		# Failed results go first, then those rarely used, cheap to recompute, large and stale
+		if failed:
+			value = 0
+		else:
+			value = (hits + 1) * (max(compute_time or 0, 0) + 60) / ((size + 2 ** 20) * (1 + age))
+		candidates.append((value, location, size))
+	return sorted(candidates)
+
+def evict_result(cursor, location):
+	for path in result_files(location):
+		if verbose:
+			print 'Removing %s' % path
+		os.remove(path)
+	cursor.execute('DELETE FROM cache_inputs WHERE query_hash IN (SELECT query_hash FROM cache WHERE location = ?)', (location,))
+	cursor.execute('DELETE FROM cache WHERE location = ?', (location,))
+
+def archive_jobs(cursor):
+	# Jobs with no remaining results are summarised then dropped, with their temporary files
+	jobs = cursor.execute('SELECT job_id, temp FROM jobs WHERE status IN (\'DONE\', \'EMPTY\', \'ERROR\') AND job_id NOT IN (SELECT job_id FROM cache)').fetchall()
+	for jobID, temp in jobs:
+		clean_temp_file(temp)
+		cursor.execute('INSERT INTO jobs_archive (job_id, status, submitted, finished) SELECT job_id, status, submitted, finished FROM jobs WHERE job_id = ?', (jobID,))
+		cursor.execute('DELETE FROM jobs WHERE job_id = ?', (jobID,))
+	return len(jobs)
+
+def evict_cache(conn, cursor, working_directory, budget):
+	usage = directory_size(working_directory)
+	if verbose:
+		print 'Using %i bytes out of %i' % (usage, budget)
+	candidates = eviction_candidates(cursor)
+	conn.commit()
+
+	# Small transactions, so that requests are not locked out while files are removed
+	while usage > budget and len(candidates) > 0:
+		for value, location, size in candidates[:EVICTION_BATCH]:
+			evict_result(cursor, location)
+			usage -= size
+			if usage <= budget:
+				break
+		conn.commit()
+		candidates = candidates[EVICTION_BATCH:]
+
+	archived = archive_jobs(cursor)
+	conn.commit()
+	if verbose:
+		print 'Now using %i bytes, archived %i jobs' % (usage, archived)
+	return usage
+
+###########################################
+## Cache invalidation
+###########################################
+
+# Datasets which were replaced or removed since results were computed from them
+def changed_inputs(cursor):
+	# Inputs recorded before identities were kept are left alone
+	reports = cursor.execute('SELECT DISTINCT location, identity FROM cache_inputs WHERE NOT derived AND identity IS NOT NULL').fetchall()
+	return sorted(set(location for location, identity in reports if file_identity(location) != identity))
+
+def cache_dependents(cursor, locations):
+	# Cache keys of the results computed from, or stored at, the given locations
+	locations = list(locations)
+	keys = set()
+	for start in range(0, len(locations), 500):
+		chunk = locations[start:start + 500]
+		marks = ",".join('?' for X in chunk)
+		keys.update(X[0] for X in cursor.execute('SELECT query_hash FROM cache_inputs WHERE location IN (%s)' % marks, chunk).fetchall())
+		keys.update(X[0] for X in cursor.execute('SELECT query_hash FROM cache WHERE location IN (%s) AND query_hash IS NOT NULL' % marks, chunk).fetchall())
+	return keys
+
+# Key of an entry kept for one job only, which no request will look up
+def detached_cache_key(key, jobID, reason):
+	return hashlib.sha1('%s\t%s\t%i' % (reason, key, jobID)).hexdigest()
+
+def detach_cache_entry(cursor, key, jobID):
+	# The job still finds its result, but later requests will not reuse it
+	detached_key = detached_cache_key(key, jobID, 'invalidated')
+	cursor.execute('UPDATE cache SET query_hash = ? WHERE query_hash = ?', (detached_key, key))
+	cursor.execute('DELETE FROM cache_inputs WHERE query_hash = ?', (key,))
+	return detached_key
+
+# Removes the results computed from the given locations, then the results computed
+# from those, and so on. Results of jobs still running are detached from the cache.
+def invalidate_cache(conn, cursor, locations):
+	invalidated = set()
+	frontier = set(locations)
+	evicted = 0
+	detached = 0
+	while len(frontier) > 0:
+		keys = cache_dependents(cursor, frontier) - invalidated
+		invalidated |= keys
+		frontier = set()
+		for key in keys:
+			for jobID, location, status in cursor.execute('SELECT cache.job_id, cache.location, jobs.status FROM cache LEFT JOIN jobs USING (job_id) WHERE cache.query_hash = ?', (key,)).fetchall():
+				if status in ['LAUNCHED', 'QUEUED']:
+					invalidated.add(detach_cache_entry(cursor, key, jobID))
+					detached += 1
+				elif location is not None:
+					evict_result(cursor, location)
+					evicted += 1
+				else:
+					cursor.execute('DELETE FROM cache WHERE query_hash = ?', (key,))
+				if location is not None:
+					frontier.add(location)
+		conn.commit()
+
+	archived = archive_jobs(cursor)
+	conn.commit()
+	if verbose:
+		print 'Invalidated %i cached results: %i removed, %i detached from running jobs, archived %i jobs' % (evicted + detached, evicted, detached, archived)
+	return evicted + detached
 
 ###########################################
 ## Search datasets
@@ -224,7 +691,26 @@ def get_attribute_values_2(cursor, attribute):
 	return [X[0] for X in cursor.execute('SELECT DISTINCT %s FROM datasets' % (attribute)).fetchall()]
 
 def get_attribute_values(cursor):
-	return dict((attribute, get_attribute_values_2(cursor, attribute)) for attribute in get_dataset_attributes(cursor))
+	snapshot = get_snapshot(cursor)
+	if snapshot is not None:
+		return snapshot.attribute_values(get_dataset_attributes(cursor))
+	res = dict()
+	for attribute, value in cursor.execute('SELECT attribute, value FROM attribute_values ORDER BY rowid'):
+		res.setdefault(attribute, []).append(value)
+	return res
+
+def get_annotation_names(cursor, assembly):
+	return [X[0] for X in cursor.execute('SELECT name FROM annotation_names WHERE assembly = ? ORDER BY rowid', (assembly,)).fetchall()]
+
+def get_catalog_version(cursor):
+	return cursor.execute('SELECT version, modified FROM catalog_version').fetchone()
+
+# Identifies the catalog across databases, None before the catalog is built
+def get_catalog_tag(cursor):
+	row = cursor.execute('SELECT catalog_id, version FROM catalog_version').fetchone()
+	if row is None:
+		return None
+	return str('%s-%i' % row)
 
 def get_annotations(cursor, assembly):
 	return cursor.execute('SELECT * FROM datasets WHERE assembly=? AND annotation', (assembly,)).fetchall()
@@ -232,7 +718,7 @@ def get_annotations(cursor, assembly):
 def get_job(cursor, job):
 	res = cursor.execute('SELECT * FROM jobs WHERE job_id = ?', (job,)).fetchall()
 	if len(res) == 0:
-		return [job, None, None, None, None, None]
+		return [job] + [None] * (len(cursor.description) - 1)
 	else:
 		return res[0]
 
@@ -253,156 +739,534 @@ def attribute_selector(attribute, params):
 def denormalize_params(params):
 	return dict(("%s_%i" % (attribute, index),value) for attribute in params for (index, value) in enumerate(params[attribute]))
 
-def get_dataset_locations(cursor, params, assembly):
+def check_params(params, assembly):
 	# Quick check that all the keys are purely alphanumeric to avoid MySQL injections
 	assert not any(re.match('\W', X) is not None for X in params)
 	params['assembly'] = [assembly]
+
+def dataset_selector(params, assembly):
+	check_params(params, assembly)
 	query = " AND ".join(attribute_selector(X, params) for X in params)
 	if verbose:
 		print 'Query: SELECT location FROM datasets WHERE ' + query
 		print 'Where:' + str(denormalize_params(params))
-	res = cursor.execute('SELECT location FROM datasets WHERE ' + query, denormalize_params(params)).fetchall()
+	return query, denormalize_params(params)
+
+def get_dataset_locations(cursor, params, assembly):
+	snapshot = get_snapshot(cursor)
+	if snapshot is not None and snapshot.covers(params):
+		check_params(params, assembly)
+		res = snapshot.locations(params)
+	else:
+		query, values = dataset_selector(params, assembly)
+		res = sorted(X[0] for X in cursor.execute('SELECT location FROM datasets WHERE ' + query, values).fetchall())
 	if verbose:
-		print 'Found:\n' + "\n".join(X[0] for X in res)
-	return sorted(X[0] for X in res)
+		print 'Found:\n' + "\n".join(res)
+	return res
+
+def count_datasets(cursor, params, assembly):
+	snapshot = get_snapshot(cursor)
+	if snapshot is not None and snapshot.covers(params):
+		check_params(params, assembly)
+		return snapshot.count(params)
+	query, values = dataset_selector(params, assembly)
+	return cursor.execute('SELECT COUNT(*) FROM datasets WHERE ' + query, values).fetchall()[0][0]
+
+###########################################
+## Catalog snapshot
+###########################################
+
+def database_file(cursor):
+	for X in cursor.execute('PRAGMA database_list').fetchall():
+		if X[1] == 'main':
+			return X[2]
+
+# Columnar copy of the datasets table next to the database file, for read-only selections
+def write_snapshot(cursor):
+	filename = database_file(cursor)
+	version = get_catalog_tag(cursor)
+	if filename and version is not None:
+		wiggledb.wiggleDB_snapshot.write_snapshot(cursor, wiggledb.wiggleDB_snapshot.snapshot_location(filename), version)
+		if verbose:
+			print 'Wrote catalog snapshot version %s' % version
+
+# Snapshot matching the datasets table, None if there is none (or numpy is missing) and SQL must be used
+def get_snapshot(cursor):
+	filename = database_file(cursor)
+	if not filename:
+		return None
+	try:
+		version = get_catalog_tag(cursor)
+	except sqlite3.OperationalError:
+		# Database not upgraded yet
+		return None
+	if version is None:
+		return None
+	return wiggledb.wiggleDB_snapshot.load_snapshot(wiggledb.wiggleDB_snapshot.snapshot_location(filename), version)
+
+###########################################
+## Facets
+###########################################
+
+# Columns which are not offered as facets
+FACET_EXCLUDED = ['location', 'assembly']
+# Columns with a distinct value per dataset, scanned rather than indexed
+FACET_UNINDEXED = ['name']
+
+def get_facet_columns(cursor):
+	return [X for X in get_dataset_attributes_2(cursor) if X not in FACET_EXCLUDED + FACET_UNINDEXED]
+
+def positions_to_bitmap(positions, size):
+	bits = bytearray((size + 7) / 8)
+	for position in positions:
+		bits[position / 8] |= 1 << (position % 8)
+	# Little endian bytes, read as a big endian hexadecimal number
+	bits.reverse()
+	return int(binascii.hexlify(str(bits)) or '0', 16)
+
+def bitmap_positions(bitmap):
+	return [X.start() for X in re.finditer('1', bin(bitmap)[:1:-1])]
+
+def popcount(bitmap):
+	return bin(bitmap).count('1')
+
+# Columns of the datasets of an assembly, with one bitmap of rows per attribute value
+def build_facet_index(cursor, assembly):
+	cursor.execute('SELECT * FROM datasets WHERE assembly = ?', (assembly,))
+	attributes = [X[0] for X in cursor.description]
+	rows = cursor.fetchall()
+	size = len(rows)
+	columns = dict()
+	bitmaps = dict()
+	totals = dict()
+	for attribute, column in zip(attributes, zip(*rows) or [()] * len(attributes)):
+		if attribute in FACET_EXCLUDED:
+			continue
+		columns[attribute] = column
+		if attribute in FACET_UNINDEXED:
+			continue
+		positions = dict()
+		for position, value in enumerate(column):
+			positions.setdefault(value, []).append(position)
+		bitmaps[attribute] = dict((value, positions_to_bitmap(positions[value], size)) for value in positions)
+		totals[attribute] = dict((value, len(positions[value])) for value in positions)
+	return {'size':size, 'all':(1 << size) - 1, 'columns':columns, 'bitmaps':bitmaps, 'totals':totals}
+
+def facet_mask(index, attribute, values):
+	if attribute in index['bitmaps']:
+		mask = 0
+		for value in values:
+			mask |= index['bitmaps'][attribute].get(value, 0)
+		return mask
+	elif attribute in index['columns']:
+		values = set(values)
+		return positions_to_bitmap([X for X, value in enumerate(index['columns'][attribute]) if value in values], index['size'])
+	else:
+		return 0
+
+# Relative cost of tallying one row in Python and of intersecting one bit of a bitmap
+FACET_TALLY_COST = 400
+
+def count_values(index, attribute, base, positions):
+	bitmaps = index['bitmaps'][attribute]
+	column = index['columns'][attribute]
+	selected = popcount(base)
+	excluded = index['size'] - selected
+	if min(selected, excluded) * FACET_TALLY_COST > len(bitmaps) * index['size']:
+		# Intersect with each value's bitmap
+		counts = dict()
+		for value in bitmaps:
+			counts[value] = popcount(base & bitmaps[value])
+	elif selected <= excluded:
+		# Tally the values of the few datasets selected
+		counts = dict()
+		for position in positions(base):
+			counts[column[position]] = counts.get(column[position], 0) + 1
+	else:
+		# Remove the few datasets left out from the totals
+		counts = dict(index['totals'][attribute])
+		for position in positions(index['all'] & ~base):
+			counts[column[position]] -= 1
+	return dict((X, counts[X]) for X in counts if counts[X] > 0)
+
+# Total selection count, and for each attribute the number of datasets of each value
+# among those matching the constraints on the other attributes
+def facet_counts(index, params, attributes):
+	masks = dict((attribute, facet_mask(index, attribute, params[attribute])) for attribute in params)
+	selection = index['all']
+	for attribute in masks:
+		selection &= masks[attribute]
+
+	# Attributes without constraints share the same datasets
+	found = dict()
+	def positions(bitmap):
+		if bitmap not in found:
+			found[bitmap] = bitmap_positions(bitmap)
+		return found[bitmap]
+
+	facets = dict()
+	for attribute in attributes:
+		if attribute not in index['bitmaps']:
+			continue
+		if attribute in masks:
+			base = index['all']
+			for other in masks:
+				if other != attribute:
+					base &= masks[other]
+		else:
+			base = selection
+		facets[attribute] = count_values(index, attribute, base, positions)
+	return {'count':popcount(selection), 'facets':facets}
+
+# Same as facet_counts, with indexed queries rather than an index built in memory, for
+# processes which answer a single request
+def query_facet_counts(cursor, params, assembly, attributes):
+	columns = get_dataset_attributes_2(cursor)
+	facet_columns = get_facet_columns(cursor)
+	attributes = [X for X in attributes if X in facet_columns]
+	if any(X not in columns or X in FACET_EXCLUDED for X in params):
+		return {'count':0, 'facets':dict((X, {}) for X in attributes)}
+
+	facets = dict()
+	for attribute in attributes:
+		others = dict((X, params[X]) for X in params if X != attribute)
+		if len(others) == 0:
+			counts = cursor.execute('SELECT value, count FROM facet_totals WHERE assembly = ? AND attribute = ?', (assembly, attribute)).fetchall()
+		else:
+			query, values = dataset_selector(others, assembly)
+			counts = cursor.execute('SELECT %s, COUNT(*) FROM datasets WHERE %s GROUP BY %s' % (attribute, query, attribute), values).fetchall()
+		facets[attribute] = dict((value, count) for value, count in counts if count > 0)
+	return {'count':count_datasets(cursor, dict(params), assembly), 'facets':facets}
 
 ###########################################
 ## Search cache
 ###########################################
 
-def reset_time_stamp(cursor, cmd):
-	cursor.execute('UPDATE cache SET last_query= date(\'now\') WHERE query = \'%s\'' % cmd)
+def file_identity(location):
+	if os.path.exists(location):
+		stat = os.stat(location)
+		return '%s\t%i\t%i' % (location, stat.st_size, stat.st_mtime)
+	else:
+		return location
+
+def cache_key(cmd, files):
+	# Content addressed: a replaced input file yields a different key
+	digest = hashlib.sha1(cmd)
+	for location in files:
+		digest.update('\n' + file_identity(location))
+	return digest.hexdigest()
+
+def reset_time_stamp(cursor, key):
+	cursor.execute('UPDATE cache SET last_query= datetime(\'now\'), hits = COALESCE(hits, 0) + 1 WHERE query_hash = ?', (key,))
 
-def get_precomputed_jobID(cursor, cmd):
-	reset_time_stamp(cursor, cmd)
-	reports = cursor.execute('SELECT job_id FROM cache WHERE query = \'%s\'' % cmd).fetchall()
+def get_precomputed_jobID(cursor, key):
+	reset_time_stamp(cursor, key)
+	reports = cursor.execute('SELECT job_id FROM cache WHERE query_hash = ?', (key,)).fetchall()
 	if len(reports) == 0:
 		if verbose:
-			print 'Did not find prior job for query: %s' % cmd
+			print 'Did not find prior job for query: %s' % key
 		return None
 	else:
 		if verbose:
-			print 'Found prior job for query: %s' % cmd
+			print 'Found prior job for query: %s' % key
 			print reports[0][0]
 		return reports[0][0]
 
 def get_job_location_2(cursor, jobID):
-	reports = cursor.execute('SELECT location FROM cache WHERE job_id = \'%s\' and primary_loc=1' % jobID).fetchall()
+	reports = cursor.execute('SELECT location FROM cache WHERE job_id = ? and primary_loc=1', (jobID,)).fetchall()
 	assert len(reports) == 1
 	return reports[0][0]
 
 def get_job_location(db, jobID):
-	connection = sqlite3.connect(db)
-	cursor = connection.cursor()
-	res = get_job_location_2(cursor, jobID)
-	connection.close()
-	return res
+	return wiggledb.wiggleDB_storage.run(db, get_job_location_2, jobID)
 
-def get_precomputed_location(cursor, cmd):
-	reports = cursor.execute('SELECT location FROM jobs NATURAL JOIN cache WHERE (status="DONE" OR status="EMPTY") AND query = ?', (cmd,)).fetchall()
+# touch=False leaves the cache statistics alone, e.g. when only explaining a query
+def get_precomputed_location(cursor, key, touch=True):
+	reports = cursor.execute('SELECT location FROM jobs NATURAL JOIN cache WHERE (status=\'DONE\' OR status=\'EMPTY\') AND query_hash = ?', (key,)).fetchall()
 	if len(reports) > 0:
-		reset_time_stamp(cursor, cmd)
+		if touch:
+			reset_time_stamp(cursor, key)
 		if verbose:
-			print 'Found pre-computed file for query: %s' % cmd
+			print 'Found pre-computed file for query: %s' % key
 			print reports[0]
 		return reports[0][0]
 	else:
 		if verbose:
-			print 'Did not find pre-computed file for query: %s' % cmd
+			print 'Did not find pre-computed file for query: %s' % key
+		return None
+
+def get_inflight_job(cursor, key):
+	# Queued jobs claim their cache entries as well, before they have a batch ID
+	reports = cursor.execute('SELECT location, job_id, status FROM jobs NATURAL JOIN cache WHERE status IN (\'LAUNCHED\', \'QUEUED\') AND query_hash = ?', (key,)).fetchall()
+	if len(reports) > 0:
+		return reports[0]
+	else:
 		return None
 
-def reuse_or_write_precomputed_location(cursor, cmd, working_directory):
-	pre_location = get_precomputed_location(cursor, cmd)
+def wait_for_submission(cursor, jobID):
+	# Jobs are claimed in the database before they are submitted to the batch system
+	for attempt in range(SUBMISSION_WAIT):
+		reports = cursor.execute('SELECT status, lsf_id FROM jobs WHERE job_id = ?', (jobID,)).fetchall()
+		if len(reports) == 0 or reports[0][0] != 'LAUNCHED':
+			return None
+		elif reports[0][1] is not None:
+			return reports[0][1]
+		# Do not keep the claiming process from recording its batch IDs
+		cursor.connection.commit()
+		time.sleep(1)
+	return None
+
+def record_cache_entry(cursor, jobID, key, query, location, primary, remember, reduction=None):
+	# Entries left by failed jobs do not block a new claim on the same key
+	cursor.execute('DELETE FROM cache WHERE query_hash = ? AND job_id IN (SELECT job_id FROM jobs WHERE status = \'ERROR\')', (key,))
+	cursor.execute('INSERT INTO cache (job_id,primary_loc,query,query_hash,remember,last_query,location,reduction) VALUES (?,?,?,?,?,datetime(\'now\'),?,?)', (jobID, int(primary), query, key, int(remember), location, reduction))
+
+def record_plot(cursor, key, plot, labels):
+	cursor.execute('UPDATE cache SET plot = ?, labels = ? WHERE query_hash = ?', (plot, json.dumps(labels), key))
+
+def record_inputs(cursor, key, files, derived=[]):
+	cursor.execute('DELETE FROM cache_inputs WHERE query_hash = ?', (key,))
+	cursor.executemany('INSERT INTO cache_inputs (query_hash, location, identity, derived) VALUES (?,?,?,0)', [(key, X, file_identity(X)) for X in files])
+	cursor.executemany('INSERT INTO cache_inputs (query_hash, location, derived) VALUES (?,?,1)', [(key, X) for X in derived])
+
+def record_reduction(cursor, jobID, key, fun, files, location):
+	prefix, reduction = split_reduction(fun)
+	if len(prefix) == 0 and reduction in DECOMPOSABLE_REDUCTIONS:
+		record_cache_entry(cursor, jobID, key, " ".join([fun] + files + [':']), location, False, False, reduction)
+	else:
+		record_cache_entry(cursor, jobID, key, " ".join([fun] + files + [':']), location, False, False)
+	record_inputs(cursor, key, files)
+
+# Returns the iterator to use in the final command, the file it refers to, whether this job
+# must compute it, whether this job owns the corresponding cache entry, and the batch job
+# computing it if it is already in flight. A result computed but not owned is a private
+# copy of an entry held by another job, see claim_job.
+def reuse_or_write_precomputed_location(cursor, fun, files, key, working_directory, attach=True):
+	pre_location = get_precomputed_location(cursor, key)
 	if pre_location is not None:
-		return pre_location, pre_location, False
+		return pre_location, pre_location, False, False, None
+
+	# Jobs still waiting in the queue cannot be depended upon, their result is computed privately
+	inflight = get_inflight_job(cursor, key)
+	if inflight is not None and attach and inflight[2] == 'LAUNCHED':
+		location, jobID, status = inflight
+		lsfID = wait_for_submission(cursor, jobID)
+		if lsfID is not None:
+			if verbose:
+				print 'Attaching to job %i computing query: %s' % (jobID, key)
+			return location, location, False, False, lsfID
+
+	fh, destination = tempfile.mkstemp(suffix='.bw',dir=working_directory)
+	os.close(fh)
+	return 'write %s %s' % (destination, plan_reduction(cursor, fun, files)), destination, True, inflight is None, None
+
+###########################################
+## Query planning
+###########################################
+
+# Reductions whose result over a set of datasets can be assembled from
+# results over disjoint subsets of that set
+DECOMPOSABLE_REDUCTIONS = ['sum', 'min', 'max', 'mean', 'unit sum', 'unit mult']
+
+def split_reduction(fun):
+	# e.g. 'gt 5 sum' is the 'gt 5' filter applied to a 'sum' reduction
+	words = fun.split(' ')
+	if len(words) > 1 and words[-2] == 'unit':
+		return " ".join(words[:-2]), " ".join(words[-2:])
+	else:
+		return " ".join(words[:-1]), words[-1]
+
+def find_cached_partials(cursor, reduction, files):
+	identities = dict((X, file_identity(X)) for X in files)
+	matched = dict()
+	# Chunked to stay below SQLite's limit on bound parameters
+	for start in range(0, len(files), 500):
+		chunk = files[start:start + 500]
+		for key, location, identity in cursor.execute('SELECT query_hash, location, identity FROM cache_inputs WHERE location IN (%s) AND NOT derived' % ",".join('?' for X in chunk), chunk).fetchall():
+			# Results computed from another version of a dataset do not count
+			if identity == identities[location]:
+				matched[key] = matched.get(key, 0) + 1
+
+	partials = []
+	for key in matched:
+		if matched[key] < 2:
+			continue
+		reports = cursor.execute('SELECT cache.location, (SELECT COUNT(*) FROM cache_inputs WHERE cache_inputs.query_hash = cache.query_hash) FROM cache NATURAL JOIN jobs WHERE cache.query_hash = ? AND cache.reduction = ? AND jobs.status = \'DONE\'', (key, reduction)).fetchall()
+		# Only results computed over a subset of the selection
+		if len(reports) > 0 and reports[0][1] == matched[key]:
+			partials.append((matched[key], key, reports[0][0]))
+	return sorted(partials, reverse=True)
+
+def plan_reduction(cursor, fun, files, touch=True):
+	cmd = " ".join([fun] + files + [':'])
+	prefix, reduction = split_reduction(fun)
+	if reduction not in DECOMPOSABLE_REDUCTIONS:
+		return cmd
+
+	# Greedily cover the selection with the largest disjoint cached results
+	remaining = set(files)
+	parts = []
+	for count, key, location in find_cached_partials(cursor, reduction, files):
+		inputs = set(X[0] for X in cursor.execute('SELECT location FROM cache_inputs WHERE query_hash = ?', (key,)).fetchall())
+		if inputs <= remaining:
+			parts.append((location, len(inputs)))
+			remaining -= inputs
+			if touch:
+				reset_time_stamp(cursor, key)
+	if len(parts) == 0:
+		return cmd
+
+	missing = [X for X in files if X in remaining]
+	if reduction == 'mean':
+		# Weighted by the number of datasets behind each partial mean
+		terms = ['scale %i %s' % (count, location) for location, count in parts]
+		words = [prefix, 'scale', repr(1.0 / len(files)), 'sum'] + terms + missing + [':']
 	else:
-		fh, destination = tempfile.mkstemp(suffix='.bw',dir=working_directory)
-		return 'write %s %s' % (destination, cmd), destination, True
+		words = [prefix, reduction] + [X[0] for X in parts] + missing + [':']
+	if verbose:
+		print 'Reusing %i cached results for %i of %i datasets' % (len(parts), len(files) - len(missing), len(files))
+	return " ".join(X for X in words if len(X) > 0)
 
-def launch_compute(conn, cursor, fun_merge, fun_A, data_A, fun_B, data_B, options, normalised_form, batch_system):
-	destination = None
-	destinationA = None
-	destinationB = None
-	cmds = None
-	options.histogram = None
-	options.apply_paste = None
+def submit_compute(cursor, cmds, chrom_sizes, batch_system, working_directory, dependency=None):
+	if batch_system == 'LOCAL':
+		return local_submit_sharded(cursor, cmds, chrom_sizes, working_directory, dependency), None
+
+	# Only needed to split jobs across a cluster
+	import wiggletools.parallelWiggleTools
+	if dependency is None:
+		return wiggletools.parallelWiggleTools.run(cmds, chrom_sizes, batch_system=batch_system, tmp=working_directory)
+	else:
+		return wiggletools.parallelWiggleTools.run(cmds, chrom_sizes, batch_system=batch_system, tmp=working_directory, dependency=dependency)
+
+def submit_finish(cursor, cmds, batch_system, working_directory, dependency=None):
+	if batch_system == 'LOCAL':
+		return local_submit(cursor, cmds, dependency), None
+
+	import wiggletools.multiJob
+	return wiggletools.multiJob.submit(cmds, batch_system=batch_system, dependency=dependency, working_directory=working_directory)
+
+# Final results which are tables (plotted) rather than tracks
+TABLE_MERGES = ['histogram', 'profile', 'profiles', 'apply_paste']
+
+def merge_suffix(fun_merge):
+	if fun_merge.split(' ')[0] in TABLE_MERGES:
+		return '.txt'
+	else:
+		return '.bw'
+
+# Returns the commands computing the merged result into destination. Steps run
+# by wiggleDB_finish.py once these are done are stored in options.
+def plan_merge(options, fun_merge, cmd_A2, destinationA, computeA, fun_B, data_B, cmd_B2, destinationB, computeB, destination):
+	merge_words = fun_merge.split(' ')
+	if merge_words[0] == 'histogram':
+		cmds = []
+		if computeA:
+			cmds = [cmd_A2]
+		if computeB:
+			cmds.append(cmd_B2)
+		width = merge_words[1]
+
+		if fun_B is not None:
+			options.histogram = "histogram %s %s %s mult %s %s" % (destination, width, destinationA, destinationA, destinationB)
+		elif data_B is not None:
+			options.histogram = "histogram %s %s %s %s" % (destination, width, destinationA, " ".join("mult %s %s" % (destinationA, X) for X in data_B))
+		options.plot = 'histogram'
+	elif merge_words[0] == 'profile':
+		cmds = [" ".join(['profile', destination, merge_words[1], cmd_B2, cmd_A2])]
+		options.plot = 'profile'
+	elif merge_words[0] == 'profiles':
+		cmds = [" ".join(['profiles', destination, merge_words[1], cmd_B2, cmd_A2])]
+		options.plot = 'profiles'
+	elif merge_words[0] == 'apply_paste':
+		cmds = []
+		if computeA:
+			cmds = [cmd_A2]
+		if computeB:
+			cmds.append(cmd_B2)
+		assert len(data_B) == 1, "Cannot apply_paste to multiple files %s\n" % " ".join(data_B)
+		options.apply_paste = " ".join(['apply_paste', destination, 'AUC', data_B[0], destinationA])
+		options.plot = 'overlaps'
+	else:
+		cmds = [" ".join(['write', destination, fun_merge, cmd_A2, cmd_B2])]
+	return cmds
+
+# Returns the ID of the job and whether it was LAUNCHED or QUEUED, or None if another
+# request claimed the query first
+def launch_compute(conn, cursor, fun_merge, fun_A, data_A, fun_B, data_B, options, normalised_form, key, batch_system, config, user=None, cost=None):
+	# Release any lock held since the cache lookups
+	conn.commit()
 
 	cmd_A = " ".join([fun_A] + data_A + [':'])
-	cmd_A2, destinationA, computeA = reuse_or_write_precomputed_location(cursor, cmd_A, options.working_directory)
+	key_A = cache_key(cmd_A, data_A)
+	cmd_A2, destinationA, computeA, ownA, dependency = reuse_or_write_precomputed_location(cursor, fun_A, data_A, key_A, options.working_directory)
+	owned = []
+	if computeA:
+		owned.append((key_A, fun_A, data_A, destinationA, not ownA))
 
 	if data_B is not None:
-		merge_words = fun_merge.split(' ')
-
 		assert fun_merge is not None
 		if fun_B is not None:
 			cmd_B = " ".join([fun_B] + data_B + [':'])
-			cmd_B2, destinationB, computeB = reuse_or_write_precomputed_location(cursor, cmd_B, options.working_directory)
+			key_B = cache_key(cmd_B, data_B)
+			# A batch job can only wait on one other job
+			cmd_B2, destinationB, computeB, ownB, dependencyB = reuse_or_write_precomputed_location(cursor, fun_B, data_B, key_B, options.working_directory, attach=dependency is None)
+			if dependencyB is not None:
+				dependency = dependencyB
+			if computeB:
+				owned.append((key_B, fun_B, data_B, destinationB, not ownB))
 		else:
 			cmd_B2 = " ".join(data_B)
+			destinationB = None
 			computeB = False
-
-		if merge_words[0] == 'histogram':
-			cmds = []
-			if computeA:
-				cmds = [cmd_A2]
-			if computeB:
-				cmds.append(cmd_B2)
-			width = merge_words[1]
-
-			fh, destination = tempfile.mkstemp(suffix='.txt',dir=options.working_directory)
-			if fun_B is not None:
-		        	options.histogram = "histogram %s %s %s mult %s %s" % (destination, width, destinationA, destinationA, destinationB)
-			elif data_B is not None:
-				options.histogram = "histogram %s %s %s %s" % (destination, width, destinationA, " ".join("mult %s %s" % (destinationA, X) for X in data_B))
-		elif merge_words[0] == 'profile':
-			fh, destination = tempfile.mkstemp(suffix='.txt',dir=options.working_directory)
-			cmds = [" ".join(['profile', destination, merge_words[1], cmd_B2, cmd_A2])]
-		elif merge_words[0] == 'profiles':
-			fh, destination = tempfile.mkstemp(suffix='.txt',dir=options.working_directory)
-			cmds = [" ".join(['profiles', destination, merge_words[1], cmd_B2, cmd_A2])]
-		elif merge_words[0] == 'apply_paste':
-			cmds = []
-			if computeA:
-				cmds = [cmd_A2]
-			if computeB:
-				cmds.append(cmd_B2)
-			fh, destination = tempfile.mkstemp(suffix='.txt',dir=options.working_directory)
-			assert len(data_B) == 1, "Cannot apply_paste to multiple files %s\n" % " ".join(data_B)
-			options.apply_paste = " ".join(['apply_paste', destination, 'AUC', data_B[0], destinationA])
-		else:
-			fh, destination = tempfile.mkstemp(suffix='.bw',dir=options.working_directory)
-			cmds = [" ".join(['write', destination, fun_merge, cmd_A2, cmd_B2])]
 	else:
+		cmd_B2 = None
+		destinationB = None
 		computeB = False
-		cmds = [cmd_A2]
-		destination = destinationA
-		destinationA = None
-
-	chrom_sizes = get_chrom_sizes(cursor, options.assembly)
-	if len(cmds) > 0:
-		lsfID, options.temps = parallelWiggleTools.run(cmds, chrom_sizes, batch_system=batch_system, tmp=options.working_directory)
-		cursor.execute('INSERT INTO jobs (lsf_id, status) VALUES (?, "LAUNCHED")', (lsfID,))
-		jobID = cursor.execute('SELECT LAST_INSERT_ROWID()').fetchall()[0][0]
-		cursor.execute('INSERT INTO cache (job_id,primary_loc,query,remember,last_query,location) VALUES (\'%s\',1,\'%s\',\'%i\',date(\'now\'),\'%s\')' % (jobID, normalised_form, int(options.remember), destination))
-		if computeA: 
-			cursor.execute('INSERT INTO cache (job_id,primary_loc,query,remember,last_query,location) VALUES (\'%s\',0,\'%s\',\'0\',date(\'now\'),\'%s\')' % (jobID, cmd_A, destinationA))
-		if computeB:
-			cursor.execute('INSERT INTO cache (job_id,primary_loc,query,remember,last_query,location) VALUES (\'%s\',0,\'%s\',\'0\',date(\'now\'),\'%s\')' % (jobID, cmd_B, destinationB))
+
+	cmds, destination = plan_result(options, fun_merge, cmd_A2, destinationA, computeA, fun_B, data_B, cmd_B2, destinationB, computeB)
+
+	# Claim the results in the database before submitting anything, so that concurrent
+	# requests attach to this job. The unique cache keys make the claim atomic, and
+	# the quotas are checked in the same transaction, so that concurrent requests count
+	# each other's jobs.
+	try:
+		wiggledb.wiggleDB_storage.begin_immediate(conn)
+		admission = admit_request(cursor, user, cost, config)
+		if admission == 'LAUNCHED':
+			status = 'LAUNCHED'
+		else:
+			status = 'QUEUED'
+		jobID = claim_job(cursor, options, key, normalised_form, destination, status, data_A + (data_B or []), [destinationA, destinationB], user, cost, owned)
+		if status == 'QUEUED':
+			queue_job(cursor, jobID, admission == 'DEFERRED', [cmds], dependency, [options.__dict__])
 		conn.commit()
+	except sqlite3.IntegrityError:
+		conn.rollback()
+		if verbose:
+			print 'Lost the race to compute query: %s' % key
+		return None
+
+	if status == 'LAUNCHED':
+		submit_job(conn, cursor, [cmds], dependency, [options.__dict__], batch_system)
+	return jobID, status
+
+# Returns the commands computing the result of a query and its location, and
+# stores the steps run by wiggleDB_finish.py in options
+def plan_result(options, fun_merge, cmd_A2, destinationA, computeA, fun_B, data_B, cmd_B2, destinationB, computeB):
+	options.histogram = None
+	options.apply_paste = None
+	options.plot = None
+	if data_B is not None:
+		fh, destination = tempfile.mkstemp(suffix=merge_suffix(fun_merge),dir=options.working_directory)
+		os.close(fh)
+		cmds = plan_merge(options, fun_merge, cmd_A2, destinationA, computeA, fun_B, data_B, cmd_B2, destinationB, computeB, destination)
 	else:
-		lsfID = None
-		cursor.execute('INSERT INTO jobs (lsf_id, status) VALUES (NULL, "LAUNCHED")')
-		jobID = cursor.execute('SELECT LAST_INSERT_ROWID()').fetchall()[0][0]
-		if options.histogram is not None:
-			cmd = options.histogram
-		elif options.apply_paste is not None:
-			cmd = options.apply_paste
-		assert cmd is not None and destination is not None
-		cursor.execute('INSERT INTO cache (job_id,primary_loc,query,remember,last_query,location) VALUES (\'%s\',1,\'%s\',\'%i\',date(\'now\'),\'%s\')' % (jobID, cmd, int(options.remember), destination))
-		options.temps = None
+		if computeA:
+			cmds = [cmd_A2]
+		else:
+			cmds = []
+		destination = destinationA
 
-	options.jobID = jobID
-	options.data = destination
 	if options.histogram is not None:
 		if fun_B is not None:
 			options.labels = ['Overall', 'Regions']
@@ -412,23 +1276,84 @@ def launch_compute(conn, cursor, fun_merge, fun_A, data_A, fun_B, data_B, option
 			options.labels = ['Overall']
 	else:
 		options.labels = None
-
-	fh, options_file = tempfile.mkstemp(dir=options.working_directory)
-	# To ensure object can be serialised and to avoid side effects
-	f = open(options_file, 'w')
-	json.dump(options.__dict__, f)
-	f.close()
-	finishCmd = 'wiggleDB_finish.py ' + options_file
-	lsfID2, temp = multiJob.submit([finishCmd], batch_system=batch_system, dependency=lsfID, working_directory=options.working_directory)
-	cursor.execute('UPDATE jobs SET lsf_id2=\'%s\',temp=\'%s\' WHERE job_id=\'%s\'' % (lsfID2, temp, jobID))
+	return cmds, destination
+
+# Records the job and its cache entries, including the partial results it computes, as
+# (key, function, files, location, private) tuples, and the datasets and cached results the
+# result is computed from. Raises sqlite3.IntegrityError if another job claimed one of them first.
+def claim_job(cursor, options, key, normalised_form, destination, status, files, derived, user, cost, owned):
+	cursor.execute('INSERT INTO jobs (status, submitted, input_bytes, user, cost, job_batch) VALUES (?, datetime(\'now\'), ?, ?, ?, ?)', (status, files_size(files), user, cost, getattr(options, 'job_batch', None)))
+	jobID = cursor.lastrowid
+	record_cache_entry(cursor, jobID, key, normalised_form, destination, True, options.remember)
+	record_inputs(cursor, key, files, [X for X in derived if X is not None and X != destination])
+	if options.plot is not None:
+		record_plot(cursor, key, options.plot, options.labels)
+	for part_key, fun, files, location, private in owned:
+		# Private copies of results held by other jobs are recorded under a key of their
+		# own, so that eviction and invalidation remove them
+		if private:
+			part_key = detached_cache_key(part_key, jobID, 'private')
+		record_reduction(cursor, jobID, part_key, fun, files, location)
+	options.jobID = jobID
+	options.data = destination
 	return jobID
 
+def queue_job(cursor, jobID, deferred, stages, dependency, settings):
+	cursor.execute('INSERT INTO job_queue (job_id, deferred, cmds, dependency, settings) VALUES (?, ?, ?, ?, ?)', (jobID, int(deferred), json.dumps(stages), dependency, json.dumps(settings)))
+
+# Submits claimed jobs: each stage of commands waits on the previous one, then one
+# finish step per job runs wiggleDB_finish.py with that job's settings (its options).
+def submit_job(conn, cursor, stages, dependency, settings, batch_system):
+	jobIDs = [X['jobID'] for X in settings]
+	working_directory = settings[0]['working_directory']
+	try:
+		chrom_sizes = get_chrom_sizes(cursor, settings[0]['assembly'])
+		# Either everything is cached, or the final step waits on another job
+		lsfID = dependency
+		temps = None
+		for cmds in stages:
+			if len(cmds) > 0:
+				lsfID, stage_temps = submit_compute(cursor, cmds, chrom_sizes, batch_system, working_directory, lsfID)
+				if temps is None:
+					temps = stage_temps
+				elif stage_temps is not None:
+					temps = list(temps) + list(stage_temps)
+
+		finishCmds = []
+		for index, job in enumerate(settings):
+			# Temporary files are cleaned once, by the first finish step
+			if index == 0:
+				job['temps'] = temps
+			else:
+				job['temps'] = None
+			fh, options_file = tempfile.mkstemp(dir=working_directory)
+			os.close(fh)
+			# To ensure object can be serialised and to avoid side effects
+			f = open(options_file, 'w')
+			json.dump(job, f)
+			f.close()
+			finishCmds.append('wiggleDB_finish.py ' + options_file)
+		lsfID2, temp = submit_finish(cursor, finishCmds, batch_system, working_directory, lsfID)
+	except:
+		# Requests waiting on these jobs must not wait forever
+		for jobID in jobIDs:
+			mark_job_status2(cursor, jobID, 'ERROR')
+		conn.commit()
+		raise
+
+	cursor.executemany('UPDATE jobs SET lsf_id=?,lsf_id2=?,temp=?,launched=datetime(\'now\') WHERE job_id=?', [(lsfID, lsfID2, temp if X == jobIDs[0] else None, X) for X in jobIDs])
+	conn.commit()
+
+def files_size(files):
+	return sum(os.path.getsize(X) for X in files if os.path.isfile(X))
+
 def get_chrom_sizes(cursor, assembly):
-	res = cursor.execute('SELECT location FROM assemblies WHERE name = \'%s\'' % (assembly)).fetchall()
+	res = cursor.execute('SELECT location FROM assemblies WHERE name = ?', (assembly,)).fetchall()
 	return res[0][0]
 
 def make_normalised_form(fun_merge, fun_A, data_A, fun_B, data_B):
 	cmd_A = " ".join([fun_A] + data_A)
+	cmd_B = None
 	if data_B is not None:
 		if fun_B is not None:
 			cmd_B = " ".join([fun_B] + data_B)
@@ -450,7 +1375,9 @@ def request_compute(conn, cursor, options, config, batch_system):
 	data_A = get_dataset_locations(cursor, options.a, options.assembly)
 	options.countA = len(data_A)
 	if len(data_A) ==  0:
-		 return {'status':'INVALID'}
+		if not options.dry_run:
+			log_request(cursor, None, None, 'INVALID')
+		return {'status':'INVALID'}
 	cmd_A = " ".join([fun_A] + data_A)
 
 	if options.b is not None:
@@ -458,42 +1385,719 @@ def request_compute(conn, cursor, options, config, batch_system):
 		data_B = get_dataset_locations(cursor, options.b, options.assembly)
 		options.countB = len(data_B)
 		if len(data_B) ==  0:
-			 return {'status':'INVALID'}
+			if not options.dry_run:
+				log_request(cursor, None, None, 'INVALID')
+			return {'status':'INVALID'}
 	else:
 		data_B = None
 		fun_B = None
 		cmd_B = None
 
 	normalised_form = make_normalised_form(options.fun_merge, fun_A, data_A, fun_B, data_B)
-	prior_jobID = get_precomputed_jobID(cursor, normalised_form)
-	if prior_jobID is not None:
-		res = query_result(cursor, prior_jobID, batch_system)
-		options.jobID = res['ID']
-		if res['status'] == 'DONE':
-			options.data = res['location']
-			report_to_user(options, config)
+	key = cache_key(normalised_form, data_A + (data_B or []))
+	if options.dry_run:
+		return explain_compute(cursor, options.fun_merge, fun_A, data_A, fun_B, data_B, options, key, batch_system)
+
+	for attempt in range(CLAIM_ATTEMPTS):
+		prior_jobID = get_precomputed_jobID(cursor, key)
+		if prior_jobID is not None:
+			res = query_result(cursor, prior_jobID)
+			options.jobID = res['ID']
+			if res['status'] in ['DONE', 'EMPTY']:
+				log_request(cursor, key, prior_jobID, 'HIT')
+			else:
+				log_request(cursor, key, prior_jobID, 'ATTACHED')
+			if res['status'] == 'DONE':
+				options.data = res['location']
+				report_to_user(cursor, options, config)
+			else:
+				acknowledge_job_to_user(cursor, options, config)
+			conn.commit()
+			return res
+
+		user = requester(options)
+		cost = request_cost(explain_compute(cursor, options.fun_merge, fun_A, data_A, fun_B, data_B, options, key, batch_system))
+		if over_cost_limit(cost, config) == 'REJECTED':
+			log_request(cursor, key, None, 'REJECTED')
+			conn.commit()
+			return {'status':'REJECTED', 'cost':cost, 'limit':parse_size(config['request_cost_limit'])}
+
+		launched = launch_compute(conn, cursor, options.fun_merge, fun_A, data_A, fun_B, data_B, options, normalised_form, key, batch_system, config, user, cost)
+		if launched is not None:
+			jobID, status = launched
+			log_request(cursor, key, jobID, 'MISS')
+			res = {'ID':jobID, 'status':status}
+			options.jobID = res['ID']
+			acknowledge_job_to_user(cursor, options, config)
+			conn.commit()
+			return res
+
+	raise Exception('Could not claim or find a job for query: %s' % normalised_form)
+
+###########################################
+## Explaining queries
+###########################################
+
+# Nothing is submitted and nothing is written to the database or the working
+# directory: files a launched query would create are shown as placeholders.
+
+def explain_part(cursor, fun, files, key, placeholder):
+	location = get_precomputed_location(cursor, key, touch=False)
+	if location is not None:
+		return location, location, False, {'key':key, 'cache':'HIT', 'location':location}
+	inflight = get_inflight_job(cursor, key)
+	if inflight is not None and inflight[2] == 'LAUNCHED':
+		return inflight[0], inflight[0], False, {'key':key, 'cache':'INFLIGHT', 'job':inflight[1]}
+	return 'write %s %s' % (placeholder, plan_reduction(cursor, fun, files, touch=False)), placeholder, True, {'key':key, 'cache':'MISS'}
+
+def explain_inputs(cmds, data):
+	# Selected datasets, and cached results reused in their stead
+	datasets = set(data)
+	words = set(X for cmd in cmds for X in cmd.split(' '))
+	return sorted(words & datasets), sorted(X for X in words - datasets if os.path.isfile(X))
+
+def explain_shards(cursor, cmds, chromosomes, batch_system):
+	shards = 0
+	reused = 0
+	for cmd in cmds:
+		if batch_system != 'LOCAL':
+			# parallelWiggleTools splits every command by chromosome
+			shards += len(chromosomes)
+		elif shardable(cmd):
+			keys = shard_keys(cmd.split(' ', 2)[2], chromosomes)
+			shards += len(keys)
+			reused += len([X for X in keys if get_shard_location(cursor, X) is not None])
+	return shards, reused
+
+def compute_rate(cursor, suffix):
+	# Seconds from launch to the end of computation (queueing included) per input byte, over past jobs with the same type of result
+	seconds, size = cursor.execute('SELECT SUM((julianday(compute_finished) - julianday(launched)) * 86400), SUM(input_bytes) FROM jobs NATURAL JOIN cache WHERE primary_loc = 1 AND location LIKE ? AND launched IS NOT NULL AND compute_finished IS NOT NULL AND input_bytes > 0', ('%' + suffix,)).fetchone()
+	if size:
+		return seconds / size
+	else:
+		return None
+
+def explain_compute(cursor, fun_merge, fun_A, data_A, fun_B, data_B, options, key, batch_system):
+	res = {'status':'EXPLAIN', 'key':key}
+	prior = cursor.execute('SELECT job_id FROM cache WHERE query_hash = ?', (key,)).fetchall()
+	if len(prior) > 0:
+		# The request would return the prior job's status, including errors
+		status = query_result(cursor, prior[0][0])['status']
+		if status in ['DONE', 'EMPTY']:
+			res['cache'] = 'HIT'
+		elif status in ['QUEUED', 'WAITING']:
+			res['cache'] = 'ATTACHED'
+		else:
+			res['cache'] = status
+		res['job'] = prior[0][0]
+		res['job_status'] = status
+		res['commands'] = []
+		res['finish'] = []
+		return res
+
+	options.histogram = None
+	options.apply_paste = None
+	options.plot = None
+	key_A = cache_key(" ".join([fun_A] + data_A + [':']), data_A)
+	cmd_A2, destinationA, computeA, res['A'] = explain_part(cursor, fun_A, data_A, key_A, '<A>.bw')
+	if data_B is not None:
+		if fun_B is not None:
+			key_B = cache_key(" ".join([fun_B] + data_B + [':']), data_B)
+			cmd_B2, destinationB, computeB, res['B'] = explain_part(cursor, fun_B, data_B, key_B, '<B>.bw')
 		else:
-			acknowledge_job_to_user(options, config)
+			cmd_B2 = " ".join(data_B)
+			destinationB = None
+			computeB = False
+		cmds = plan_merge(options, fun_merge, cmd_A2, destinationA, computeA, fun_B, data_B, cmd_B2, destinationB, computeB, '<result>' + merge_suffix(fun_merge))
+	elif computeA:
+		cmds = [cmd_A2]
+	else:
+		cmds = []
+	finish = [X for X in [options.histogram, options.apply_paste] if X is not None]
+
+	chromosomes = chromosome_lengths(get_chrom_sizes(cursor, options.assembly))
+	shards, reused = explain_shards(cursor, cmds, chromosomes, batch_system)
+	datasets, cached = explain_inputs(cmds + finish, data_A + (data_B or []))
+	input_bytes = files_size(datasets + cached)
+	if options.plot is not None:
+		rate = compute_rate(cursor, '.txt')
+	else:
+		rate = compute_rate(cursor, '.bw')
+	if len(cmds) == 0:
+		work = 0
+	elif shards > 0:
+		# Reused shards are not recomputed
+		work = input_bytes * (shards - reused) / shards
+	else:
+		work = input_bytes
+	if rate is None:
+		seconds = None
+	else:
+		seconds = rate * work
+
+	res['cache'] = 'MISS'
+	res['commands'] = cmds
+	res['finish'] = finish
+	res['cost'] = {'datasets':len(datasets), 'cached_inputs':len(cached), 'input_bytes':input_bytes, 'work_bytes':work, 'chromosomes':len(chromosomes), 'shards':shards, 'reused_shards':reused, 'output':options.plot or 'track', 'estimated_seconds':seconds}
+	if verbose:
+		print 'Would run:\n' + "\n".join(cmds + finish)
+	return res
+
+
+###########################################
+## Admission control
+###########################################
+
+# Configuration settings, all optional:
+#  max_jobs: jobs running at the same time
+#  user_jobs: jobs running at the same time for one user
+#  user_cost: total cost of the jobs running for one user, e.g. 20G
+#  request_cost_limit: cost above which requests are rejected, or deferred if over_limit is 'defer'
+# The cost of a request is the size of the inputs it still has to read (see explain_compute).
+# Requests beyond these quotas are claimed but queued, and submitted by dispatch_queued_jobs.
+
+def requester(options):
+	emails = [X for X in options.emails or [] if len(X) > 0]
+	if len(emails) > 0:
+		return emails[0].lower()
+	elif getattr(options, 'user', None) is not None:
+		return options.user
 	else:
-		res = {'ID':launch_compute(conn, cursor, options.fun_merge, fun_A, data_A, fun_B, data_B, options, normalised_form, batch_system), 'status':'LAUNCHED'}
-		options.jobID = res['ID']
-		acknowledge_job_to_user(options, config)
+		return 'anonymous'
 
+def request_cost(explanation):
+	if 'cost' in explanation:
+		return int(explanation['cost']['work_bytes'])
+	else:
+		return 0
+
+# Number and total cost of running jobs, by user
+def running_jobs(cursor):
+	return dict((X[0], (X[1], X[2] or 0)) for X in cursor.execute('SELECT user, COUNT(*), SUM(cost) FROM jobs WHERE status = \'LAUNCHED\' GROUP BY user').fetchall())
+
+def within_quotas(running, user, cost, config):
+	if 'max_jobs' in config and sum(X[0] for X in running.values()) >= int(config['max_jobs']):
+		return False
+	count, total = running.get(user, (0, 0))
+	if 'user_jobs' in config and count >= int(config['user_jobs']):
+		return False
+	# One job may exceed the cost quota on its own, request_cost_limit caps it
+	if 'user_cost' in config and count > 0 and total + cost > parse_size(config['user_cost']):
+		return False
+	return True
+
+# Returns DEFERRED or REJECTED for requests over request_cost_limit, None otherwise
+def over_cost_limit(cost, config):
+	if 'request_cost_limit' in config and cost > parse_size(config['request_cost_limit']):
+		if config.get('over_limit', 'reject') == 'defer':
+			return 'DEFERRED'
+		else:
+			return 'REJECTED'
+	return None
+
+# Returns LAUNCHED, QUEUED, DEFERRED or REJECTED. Run it in the write transaction
+# which claims the job, see begin_immediate
+def admit_request(cursor, user, cost, config):
+	over_limit = over_cost_limit(cost, config)
+	if over_limit is not None:
+		return over_limit
+	# Requests of a user are not reordered
+	if cursor.execute('SELECT COUNT(*) FROM jobs WHERE user = ? AND status = \'QUEUED\'', (user,)).fetchone()[0] > 0:
+		return 'QUEUED'
+	if not within_quotas(running_jobs(cursor), user, cost, config):
+		return 'QUEUED'
+	return 'LAUNCHED'
+
+def next_queued_job(cursor, config):
+	running = running_jobs(cursor)
+	# Batches cost as much as all their jobs
+	queued = cursor.execute('SELECT job_queue.job_id, user, (SELECT SUM(cost) FROM jobs AS batch WHERE batch.job_id = jobs.job_id OR batch.job_batch = jobs.job_batch), deferred FROM job_queue JOIN jobs ON jobs.job_id = job_queue.job_id ORDER BY deferred, job_queue.job_id').fetchall()
+	# Each user's jobs run in order
+	heads = dict()
+	for job in queued:
+		heads.setdefault(job[1], job)
+	# Deferred jobs last, then users with the fewest running jobs, then the cheapest jobs
+	for jobID, user, cost, deferred in sorted(heads.values(), key=lambda X: (X[3], running.get(X[1], (0, 0))[0], X[2], X[0])):
+		# Deferred jobs only run when nothing else does
+		if deferred and len(running) > 0:
+			continue
+		if within_quotas(running, user, cost, config):
+			return jobID
+	return None
+
+# Submits queued jobs as long as quotas allow, returns how many were submitted
+def dispatch_queued_jobs(conn, cursor, config, batch_system):
+	count = 0
+	while True:
+		# The quotas are checked and the job taken off the queue in one write transaction
+		wiggledb.wiggleDB_storage.begin_immediate(conn)
+		jobID = next_queued_job(cursor, config)
+		if jobID is None:
+			conn.commit()
+			return count
+		stages, dependency, settings = cursor.execute('SELECT cmds, dependency, settings FROM job_queue WHERE job_id = ?', (jobID,)).fetchone()
+		settings = json.loads(settings)
+		# Only one dispatcher takes the job off the queue
+		cursor.execute('DELETE FROM job_queue WHERE job_id = ?', (jobID,))
+		if cursor.rowcount == 0:
+			conn.rollback()
+			continue
+		cursor.executemany('UPDATE jobs SET status = \'LAUNCHED\' WHERE job_id = ?', [(X['jobID'],) for X in settings])
+		conn.commit()
+		if verbose:
+			print 'Dispatching queued job %i' % jobID
+		submit_job(conn, cursor, json.loads(stages), dependency, settings, batch_system)
+		count += 1
+
+###########################################
+## Batches
+###########################################
+
+# A manifest is a JSON object with an assembly, optional e-mail addresses, and either
+# a list of queries, or a matrix of queries comparing each selection in a with each one in b:
+#  {"assembly":"GRCh38", "emails":[...], "queries":[{"a":{...}, "wa":"mean", "b":{...}, "wb":..., "w":"diff"}, ...]}
+#  {"assembly":"GRCh38", "matrix":{"a":[{...}, ...], "wa":"mean", "b":[{...}, ...], "w":"profile 100"}}
+
+def manifest_queries(manifest):
+	queries = list(manifest.get('queries', []))
+	if 'matrix' in manifest:
+		matrix = manifest['matrix']
+		for A in matrix['a']:
+			for B in matrix['b']:
+				queries.append({'a':A, 'wa':matrix['wa'], 'b':B, 'wb':matrix.get('wb'), 'w':matrix['w']})
+	return queries
+
+def query_options(options, manifest, query):
+	res = copy.copy(options)
+	res.assembly = manifest.get('assembly', options.assembly)
+	res.emails = manifest.get('emails', options.emails)
+	res.a = query['a']
+	res.wa = query['wa']
+	res.b = query.get('b')
+	res.wb = query.get('wb')
+	res.fun_merge = query.get('w')
+	# The batch is acknowledged as a whole, its jobs still report their results
+	res.acknowledge = False
 	return res
 
+def get_batch(cursor, batchID):
+	reports = cursor.execute('SELECT queries FROM job_batches WHERE job_batch = ?', (batchID,)).fetchall()
+	if len(reports) == 0:
+		return None
+	return json.loads(reports[0][0])
+
+# Current result of each query of a batch
+def batch_result(cursor, batchID):
+	handles = get_batch(cursor, batchID)
+	if handles is None:
+		return {'batch':batchID, 'status':'UNKNOWN'}
+	queries = []
+	for handle in handles:
+		if 'ID' in handle:
+			queries.append(query_result(cursor, handle['ID']))
+		else:
+			queries.append(handle)
+	return {'batch':batchID, 'queries':queries}
+
+def record_batch(cursor, user, handles):
+	cursor.execute('INSERT INTO job_batches (submitted, user, queries) VALUES (datetime(\'now\'), ?, ?)', (user, json.dumps(handles)))
+	return cursor.lastrowid
+
+# Submits all the queries of a manifest at once. Partial results needed by several
+# queries are computed once, in a first stage; then the queries are computed by a
+# single array of commands, and finished by a single array of finish steps.
+def request_batch(conn, cursor, options, manifest, config, batch_system):
+	queries = [query_options(options, manifest, X) for X in manifest_queries(manifest)]
+	if options.dry_run:
+		return {'status':'EXPLAIN', 'queries':[request_compute(conn, cursor, X, config, batch_system) for X in queries]}
+
+	# The e-mail addresses of the manifest identify the user
+	user = requester(query_options(options, manifest, {'a':None, 'wa':None}))
+	handles = [None] * len(queries)
+	pending = []
+	first = dict()
+	for index, query in enumerate(queries):
+		data_A = get_dataset_locations(cursor, query.a, query.assembly)
+		query.countA = len(data_A)
+		if query.b is not None:
+			data_B = get_dataset_locations(cursor, query.b, query.assembly)
+			query.countB = len(data_B)
+			fun_B = query.wb
+		else:
+			data_B = None
+			fun_B = None
+		if len(data_A) == 0 or (data_B is not None and len(data_B) == 0):
+			log_request(cursor, None, None, 'INVALID')
+			handles[index] = {'status':'INVALID'}
+			continue
+
+		normalised_form = make_normalised_form(query.fun_merge, query.wa, data_A, fun_B, data_B)
+		key = cache_key(normalised_form, data_A + (data_B or []))
+		# The same query twice in the batch gets the same job
+		if key in first:
+			handles[index] = first[key]
+			continue
+		prior_jobID = get_precomputed_jobID(cursor, key)
+		if prior_jobID is not None:
+			res = query_result(cursor, prior_jobID)
+			if res['status'] in ['DONE', 'EMPTY']:
+				log_request(cursor, key, prior_jobID, 'HIT')
+			else:
+				log_request(cursor, key, prior_jobID, 'ATTACHED')
+			handles[index] = {'ID':prior_jobID}
+			first[key] = handles[index]
+			continue
+
+		cost = request_cost(explain_compute(cursor, query.fun_merge, query.wa, data_A, fun_B, data_B, query, key, batch_system))
+		handles[index] = {'ID':None}
+		first[key] = handles[index]
+		pending.append((handles[index], query, data_A, fun_B, data_B, normalised_form, key, cost))
+
+	total_cost = sum(X[-1] for X in pending)
+	if len(pending) == 0 or over_cost_limit(total_cost, config) == 'REJECTED':
+		for handle, query, data_A, fun_B, data_B, normalised_form, key, cost in pending:
+			log_request(cursor, key, None, 'REJECTED')
+			handle.pop('ID')
+			handle['status'] = 'REJECTED'
+		batchID = record_batch(cursor, user, handles)
+		conn.commit()
+		return batch_result(cursor, batchID)
+	# Release any lock held since the cache lookups
+	conn.commit()
+
+	# Partial results needed by the queries, in order of first use
+	parts = []
+	uses = dict()
+	for handle, query, data_A, fun_B, data_B, normalised_form, key, cost in pending:
+		for fun, files in [(query.wa, data_A), (fun_B, data_B)]:
+			if fun is not None:
+				part_key = cache_key(" ".join([fun] + files + [':']), files)
+				if part_key not in uses:
+					parts.append((part_key, fun, files))
+				uses[part_key] = uses.get(part_key, 0) + 1
+
+	dependency = None
+	prepare = []
+	planned = dict()
+	owned = []
+	for part_key, fun, files in parts:
+		# A batch job can only wait on one other job
+		cmd2, location, compute, own, part_dependency = reuse_or_write_precomputed_location(cursor, fun, files, part_key, options.working_directory, attach=dependency is None)
+		if part_dependency is not None:
+			dependency = part_dependency
+		if compute:
+			owned.append((part_key, fun, files, location, not own))
+		if compute and uses[part_key] > 1:
+			prepare.append(cmd2)
+			planned[part_key] = (location, location, False)
+		else:
+			planned[part_key] = (cmd2, location, compute)
+
+	cmds = []
+	plans = []
+	for handle, query, data_A, fun_B, data_B, normalised_form, key, cost in pending:
+		cmd_A2, destinationA, computeA = planned[cache_key(" ".join([query.wa] + data_A + [':']), data_A)]
+		if fun_B is not None:
+			cmd_B2, destinationB, computeB = planned[cache_key(" ".join([fun_B] + data_B + [':']), data_B)]
+		elif data_B is not None:
+			cmd_B2, destinationB, computeB = " ".join(data_B), None, False
+		else:
+			cmd_B2, destinationB, computeB = None, None, False
+		query_cmds, destination = plan_result(query, query.fun_merge, cmd_A2, destinationA, computeA, fun_B, data_B, cmd_B2, destinationB, computeB)
+		cmds.extend(query_cmds)
+		plans.append((destination, [destinationA, destinationB]))
+
+	# Files created by the planning, for the partial results to compute and the merged results
+	created = [X[3] for X in owned] + [destination for (destination, derived), query in zip(plans, pending) if query[4] is not None]
+
+	try:
+		# As in launch_compute, the quotas are checked in the transaction claiming the jobs
+		wiggledb.wiggleDB_storage.begin_immediate(conn)
+		admission = admit_request(cursor, user, total_cost, config)
+		if admission == 'LAUNCHED':
+			status = 'LAUNCHED'
+		else:
+			status = 'QUEUED'
+		batchID = record_batch(cursor, user, [])
+		for (handle, query, data_A, fun_B, data_B, normalised_form, key, cost), (destination, derived) in zip(pending, plans):
+			query.job_batch = batchID
+			# Partial results are recorded against the first job
+			handle['ID'] = claim_job(cursor, query, key, normalised_form, destination, status, data_A + (data_B or []), derived, user, cost, owned)
+			owned = []
+		cursor.execute('UPDATE job_batches SET queries = ? WHERE job_batch = ?', (json.dumps(handles), batchID))
+		settings = [X[1].__dict__ for X in pending]
+		if status == 'QUEUED':
+			queue_job(cursor, pending[0][0]['ID'], admission == 'DEFERRED', [prepare, cmds], dependency, settings)
+		for handle, query, data_A, fun_B, data_B, normalised_form, key, cost in pending:
+			log_request(cursor, key, handle['ID'], 'MISS')
+		conn.commit()
+	except sqlite3.IntegrityError:
+		conn.rollback()
+		if verbose:
+			print 'Lost the race to compute a query of the batch, submitting them one by one'
+		for location in created:
+			if os.path.exists(location):
+				os.remove(location)
+		return request_batch_by_query(conn, cursor, options, manifest, config, batch_system, user)
+
+	if status == 'LAUNCHED':
+		submit_job(conn, cursor, [prepare, cmds], dependency, settings, batch_system)
+	res = batch_result(cursor, batchID)
+	acknowledge_batch_to_user(cursor, options, manifest, config, res)
+	conn.commit()
+	return res
+
+def request_batch_by_query(conn, cursor, options, manifest, config, batch_system, user):
+	handles = []
+	for query in manifest_queries(manifest):
+		res = request_compute(conn, cursor, query_options(options, manifest, query), config, batch_system)
+		if 'ID' in res:
+			handles.append({'ID':res['ID']})
+		else:
+			handles.append({'status':res['status']})
+	batchID = record_batch(cursor, user, handles)
+	res = batch_result(cursor, batchID)
+	acknowledge_batch_to_user(cursor, options, manifest, config, res)
+	conn.commit()
+	return res
+
+####################################################
+## Local batch system
+####################################################
+
+def create_local_tables(cursor):
+	# Batches play the part of cluster job arrays: a set of commands run after another batch
+	cursor.execute('''
+	CREATE TABLE IF NOT EXISTS
+	local_batches
+	(
+	batch_id INTEGER PRIMARY KEY AUTOINCREMENT,
+	dependency int,
+	priority int,
+	submitted datetime
+	)
+	''')
+	cursor.execute('''
+	CREATE TABLE IF NOT EXISTS
+	local_tasks
+	(
+	task_id INTEGER PRIMARY KEY AUTOINCREMENT,
+	batch_id int,
+	cmd varchar(10000),
+	status varchar(255),
+	return_code int
+	)
+	''')
+	add_missing_columns(cursor, 'local_tasks', [('attempts', 'int DEFAULT 0'), ('shard_key', 'char(40)'), ('location', 'varchar(1000)')])
+	cursor.execute('CREATE INDEX IF NOT EXISTS local_tasks_status ON local_tasks (status)')
+	cursor.execute('CREATE INDEX IF NOT EXISTS local_tasks_batch_id ON local_tasks (batch_id)')
+
+	# Finished per chromosome outputs, reusable by any command with the same iterator
+	cursor.execute('''
+	CREATE TABLE IF NOT EXISTS
+	shards
+	(
+	shard_key char(40) PRIMARY KEY,
+	location varchar(1000),
+	finished datetime
+	)
+	''')
+
+def local_submit(cursor, cmds, dependency=None, priority=0):
+	cursor.execute('INSERT INTO local_batches (dependency, priority, submitted) VALUES (?, ?, datetime(\'now\'))', (dependency, priority))
+	batchID = cursor.lastrowid
+	local_add_tasks(cursor, batchID, [(X, None, None) for X in cmds])
+	return batchID
+
+def local_add_tasks(cursor, batchID, tasks):
+	cursor.executemany('INSERT INTO local_tasks (batch_id, cmd, status, shard_key, location) VALUES (?, ?, \'QUEUED\', ?, ?)', [(batchID,) + tuple(X) for X in tasks])
+
+def chromosome_lengths(chrom_sizes):
+	# In the order bedGraphToBigWig expects
+	return sorted(line.strip().split('\t')[:2] for line in open(chrom_sizes) if len(line.strip()) > 0)
+
+def shardable(cmd):
+	# Nested writes would be overwritten by each shard
+	words = cmd.split(' ')
+	return words[0] == 'write' and words[1][-3:] == '.bw' and 'write' not in words[2:] and 'write_bg' not in words[2:]
+
+def get_shard_location(cursor, key):
+	reports = cursor.execute('SELECT location FROM shards WHERE shard_key = ?', (key,)).fetchall()
+	if len(reports) > 0 and os.path.exists(reports[0][0]):
+		return reports[0][0]
+	else:
+		return None
+
+def shard_keys(iterator, chromosomes):
+	base_key = cache_key(iterator, iterator.split(' '))
+	return [hashlib.sha1('%s\t%s\t%s' % (base_key, chrom, length)).hexdigest() for chrom, length in chromosomes]
+
+def plan_shards(cursor, cmd, chrom_sizes, chromosomes, working_directory):
+	words = cmd.split(' ', 2)
+	destination = words[1]
+	iterator = words[2]
+	shard_directory = os.path.join(working_directory, 'shards')
+	if not os.path.exists(shard_directory):
+		os.makedirs(shard_directory)
+
+	tasks = []
+	locations = []
+	for (chrom, length), key in zip(chromosomes, shard_keys(iterator, chromosomes)):
+		location = get_shard_location(cursor, key)
+		if location is None:
+			fh, location = tempfile.mkstemp(suffix='.bg', dir=shard_directory)
+			os.close(fh)
+			tasks.append((" ".join(['wiggletools', 'write_bg', location, 'seek', chrom, '0', length, iterator]), key, location))
+		elif verbose:
+			print 'Reusing shard %s of %s' % (chrom, iterator)
+		locations.append(location)
+
+	merge = 'cat %s > %s.bg && bedGraphToBigWig %s.bg %s %s && rm %s.bg' % (" ".join(locations), destination, destination, chrom_sizes, destination, destination)
+	return tasks, merge
+
+def local_submit_sharded(cursor, cmds, chrom_sizes, working_directory, dependency=None):
+	# Each chromosome is a separate task, so that a failure only reruns that chromosome
+	chromosomes = chromosome_lengths(chrom_sizes)
+	tasks = []
+	merges = []
+	for cmd in cmds:
+		if shardable(cmd):
+			shards, merge = plan_shards(cursor, cmd, chrom_sizes, chromosomes, working_directory)
+			tasks.extend(shards)
+			merges.append(merge)
+		else:
+			tasks.append(('wiggletools ' + cmd, None, None))
+	batchID = local_submit(cursor, [], dependency)
+	local_add_tasks(cursor, batchID, tasks)
+	if len(merges) > 0:
+		return local_submit(cursor, merges, batchID)
+	else:
+		return batchID
+
+def local_ready_tasks(cursor, count):
+	# Highest priority first, then first come first served, once the batch waited on has succeeded
+	return cursor.execute('''
+		SELECT local_tasks.task_id, local_tasks.cmd 
+		FROM local_tasks JOIN local_batches USING (batch_id) 
+		WHERE local_tasks.status = \'QUEUED\' 
+		AND NOT EXISTS (SELECT * FROM local_tasks AS previous WHERE previous.batch_id = local_batches.dependency AND previous.status != \'DONE\') 
+		ORDER BY local_batches.priority DESC, local_tasks.task_id 
+		LIMIT ?
+		''', (count,)).fetchall()
+
+def mark_local_task(cursor, taskID, status, return_code=None):
+	cursor.execute('UPDATE local_tasks SET status = ?, return_code = ? WHERE task_id = ?', (status, return_code, taskID))
+
+# Returns False if the task was claimed by someone else in the meantime
+def claim_local_task(cursor, taskID):
+	return cursor.execute('UPDATE local_tasks SET status = \'RUNNING\', return_code = NULL WHERE task_id = ? AND status = \'QUEUED\'', (taskID,)).rowcount == 1
+
+def finish_local_task(cursor, taskID, return_code, retries=LOCAL_RETRIES):
+	if return_code == 0:
+		mark_local_task(cursor, taskID, 'DONE', return_code)
+		cursor.execute('INSERT OR REPLACE INTO shards (shard_key, location, finished) SELECT shard_key, location, datetime(\'now\') FROM local_tasks WHERE task_id = ? AND shard_key IS NOT NULL', (taskID,))
+	elif cursor.execute('SELECT COALESCE(attempts, 0) FROM local_tasks WHERE task_id = ?', (taskID,)).fetchone()[0] < retries:
+		if verbose:
+			print 'Retrying task %i after return code %i' % (taskID, return_code)
+		cursor.execute('UPDATE local_tasks SET status = \'QUEUED\', return_code = ?, attempts = COALESCE(attempts, 0) + 1 WHERE task_id = ?', (return_code, taskID))
+	else:
+		mark_local_task(cursor, taskID, 'FAILED', return_code)
+		cancel_local_tasks(cursor)
+
+def cancel_local_tasks(cursor):
+	# Batches waiting on a failed batch will never run
+	while cursor.execute('''
+		UPDATE local_tasks SET status = \'CANCELLED\' 
+		WHERE status = \'QUEUED\' 
+		AND batch_id IN (SELECT local_batches.batch_id FROM local_batches JOIN local_tasks AS previous ON previous.batch_id = local_batches.dependency WHERE previous.status IN (\'FAILED\', \'CANCELLED\'))
+		''').rowcount > 0:
+		pass
+
+def requeue_local_tasks(cursor):
+	# Tasks interrupted by a restart of the worker are run again. Only safe when
+	# called by the one worker of the database (see wiggleDB_worker.py)
+	create_local_tables(cursor)
+	cursor.execute('UPDATE local_tasks SET status = \'QUEUED\' WHERE status = \'RUNNING\'')
+
+def local_batch_chain(cursor, batchID):
+	batches = []
+	while batchID is not None:
+		batches.append(batchID)
+		reports = cursor.execute('SELECT dependency FROM local_batches WHERE batch_id = ?', (batchID,)).fetchall()
+		if len(reports) == 0:
+			break
+		batchID = reports[0][0]
+	return batches
+
+# Batches of the job, from its finish batch back to the first of its compute batches.
+# The chain stops at a batch run for other jobs, such as an in-flight result it waits on.
+def local_job_batches(cursor, jobID, finishID):
+	batches = []
+	for batchID in local_batch_chain(cursor, finishID):
+		owners = cursor.execute('SELECT job_id, status FROM jobs WHERE lsf_id = ? OR lsf_id2 = ?', (batchID, batchID)).fetchall()
+		if len(owners) > 0 and jobID not in [X[0] for X in owners]:
+			failed = [X[0] for X in owners if X[1] == 'ERROR']
+			assert len(failed) == 0, 'Job %s depends on failed job %s, retry that one first' % (jobID, failed[0])
+			break
+		batches.append(batchID)
+	return batches
+
+def retry_local_job(cursor, jobID):
+	# Only failed and cancelled tasks are run again, finished shards are kept
+	reports = cursor.execute('SELECT lsf_id2 FROM jobs WHERE job_id = ? AND status = \'ERROR\'', (jobID,)).fetchall()
+	assert len(reports) == 1 and reports[0][0] is not None, 'Job %s is not a failed job' % jobID
+	finishID = int(reports[0][0])
+	batches = local_job_batches(cursor, int(jobID), finishID)
+	cursor.execute('UPDATE local_tasks SET status = \'QUEUED\', attempts = 0, return_code = NULL WHERE status IN (\'FAILED\', \'CANCELLED\') AND batch_id IN (%s)' % ",".join('?' for X in batches), batches)
+	# The jobs of a batch share their batches, and are retried together
+	cursor.execute('UPDATE jobs SET status = \'LAUNCHED\', lsf_state = NULL, lsf_state2 = NULL, return_values = NULL, finished = NULL WHERE lsf_id2 = ? AND status = \'ERROR\'', (finishID,))
+
+def clean_shards(cursor, days):
+	for location in cursor.execute('SELECT location FROM shards WHERE julianday(\'now\') - julianday(finished) > ?', (days,)).fetchall():
+		if os.path.exists(location[0]):
+			os.remove(location[0])
+	cursor.execute('DELETE FROM shards WHERE julianday(\'now\') - julianday(finished) > ?', (days,))
+
+def poll_local_jobs(cursor, lsfIDs):
+	lsfIDs = list(lsfIDs)
+	values = dict()
+	for start in range(0, len(lsfIDs), 500):
+		chunk = lsfIDs[start:start + 500]
+		for batchID, status, return_code in cursor.execute('SELECT batch_id, status, return_code FROM local_tasks WHERE batch_id IN (%s)' % ",".join('?' for X in chunk), chunk).fetchall():
+			values.setdefault(batchID, []).append((status, return_code))
+	states = dict()
+	for batchID in values:
+		codes = [str(X[1]) for X in values[batchID] if X[1] is not None]
+		if any(X[0] in ['FAILED', 'CANCELLED'] for X in values[batchID]):
+			states[batchID] = ('FAILED', codes)
+		elif all(X[0] == 'DONE' for X in values[batchID]):
+			states[batchID] = ('DONE', codes)
+		else:
+			states[batchID] = ('RUNNING', codes)
+	return states
 
 ####################################################
 ## Querying jobs
 ####################################################
 
-def sge_job_running(lsfID):
-	return subprocess.Popen(['qstat','-j',str(lsfID)], stdout=subprocess.PIPE, stderr=subprocess.PIPE).wait() == 0
+def sge_queued_jobs():
+	# A single qstat call lists every job still pending or running
+	p = subprocess.Popen(['qstat','-u','*'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	(stdout, stderr) = p.communicate()
+	assert p.returncode == 0, 'Error when polling SGE: %s' % stderr
+	queued = set()
+	for line in stdout.split('\n'):
+		items = line.split()
+		if len(items) > 0 and items[0].isdigit():
+			queued.add(int(items[0]))
+	return queued
 
 def sge_job_return_values(lsfID):
 	p = subprocess.Popen(['qacct','-j',str(lsfID)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	p.wait()
 	(stdout, stderr) = p.communicate()
-	assert p.returncode == 0, 'Error when polling SGE job %i' % lsfID
+	if p.returncode != 0:
+		# Job not in the accounting file yet
+		return None
 	values = []
 	failedTask = False
 	for line in stdout.split('\n'):
@@ -503,95 +2107,300 @@ def sge_job_return_values(lsfID):
 			failedTask = True
 		elif items[0] == 'exit_status': 
 			if failedTask:
-				failedTaskID = False
+				failedTask = False
 			else:
 				values.append(items[1])
 	return values
 
+def poll_sge_jobs(cursor, lsfIDs):
+	queued = sge_queued_jobs()
+	states = dict()
+	for lsfID in lsfIDs:
+		if lsfID in queued:
+			states[lsfID] = ('RUNNING', [])
+		else:
+			values = sge_job_return_values(lsfID)
+			if values is None:
+				continue
+			elif any(X != '0' for X in values):
+				states[lsfID] = ('FAILED', values)
+			else:
+				states[lsfID] = ('DONE', values)
+	return states
+
+# States of finished jobs (and of each element of job arrays), from the event logs
+def lsf_job_history(lsfIDs):
+	p = subprocess.Popen(['bhist','-l','-n','0'] + [str(X) for X in lsfIDs], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	(stdout, stderr) = p.communicate()
+	# Long lines are wrapped onto indented lines
+	text = re.sub('\n {21}', '', stdout)
+	values = dict()
+	for block in re.split('\n-{10,}\n', text):
+		match = re.search('Job <(\d+)(\[\d+\])?>', block)
+		if match is None:
+			continue
+		if 'Exited' in block:
+			values.setdefault(int(match.group(1)), []).append('EXIT')
+		elif 'Done successfully' in block:
+			values.setdefault(int(match.group(1)), []).append('DONE')
+	return values
+
+def poll_lsf_jobs(cursor, lsfIDs):
+	if len(lsfIDs) == 0:
+		return dict()
+	# A single bjobs call for all the jobs, finished or not
+	p = subprocess.Popen(['bjobs','-noheader','-a'] + [str(X) for X in lsfIDs], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	(stdout, stderr) = p.communicate()
+	values = dict()
+	for line in stdout.split('\n'):
+		items = line.split()
+		if len(items) > 2 and items[0].isdigit():
+			values.setdefault(int(items[0]), []).append(items[2])
+	# Finished jobs are dropped from bjobs after CLEAN_PERIOD, and are looked up in the event logs.
+	# Only jobs reported as not found are, so that an unreachable LSF leaves all jobs as they are.
+	missing = [int(X) for X in re.findall('Job <(\d+)> is not found', stderr)]
+	if len(missing) > 0:
+		history = lsf_job_history(missing)
+		for lsfID in missing:
+			# Not even in the event logs, the job will never be reported on
+			values[lsfID] = history.get(lsfID, ['LOST'])
+	states = dict()
+	for lsfID in values:
+		if 'EXIT' in values[lsfID] or 'LOST' in values[lsfID]:
+			states[lsfID] = ('FAILED', values[lsfID])
+		elif all(X == 'DONE' for X in values[lsfID]):
+			states[lsfID] = ('DONE', values[lsfID])
+		else:
+			states[lsfID] = ('RUNNING', values[lsfID])
+	return states
+
+# A poller maps a database cursor and a set of batch IDs to (state, return values) pairs,
+# where the state is RUNNING, DONE or FAILED. Jobs it does not report on are left as they are.
+BATCH_POLLERS = {'SGE': poll_sge_jobs, 'LSF': poll_lsf_jobs, 'LOCAL': poll_local_jobs}
+
+def batch_system_poller(batch_system):
+	if batch_system not in BATCH_POLLERS:
+		raise NameError('Unknown batch system %s' % batch_system)
+	return BATCH_POLLERS[batch_system]
+
+def update_job_statuses(cursor, poll):
+	jobs = cursor.execute('SELECT job_id, lsf_id, lsf_id2, lsf_state, lsf_state2 FROM jobs WHERE status = \'LAUNCHED\' AND lsf_id2 IS NOT NULL').fetchall()
+	pending = set()
+	for jobID, lsfID, lsfID2, state, state2 in jobs:
+		if lsfID is not None and state not in ['DONE', 'FAILED']:
+			pending.add(int(lsfID))
+		if state2 not in ['DONE', 'FAILED']:
+			pending.add(int(lsfID2))
+	if len(pending) == 0:
+		return
+
+	states = poll(cursor, pending)
+	for jobID, lsfID, lsfID2, state, state2 in jobs:
+		status = 'LAUNCHED'
+		values = None
+		if lsfID is not None and int(lsfID) in states:
+			state, values = states[int(lsfID)]
+		if int(lsfID2) in states:
+			state2, values2 = states[int(lsfID2)]
+			if state != 'FAILED':
+				values = values2
+		if state == 'FAILED' or state2 == 'FAILED':
+			status = 'ERROR'
+		if verbose:
+			print 'Job %i: %s %s %s' % (jobID, state, state2, status)
+		# The finish job may have marked the job DONE or EMPTY in the meantime
+		if values is not None:
+			values = json.dumps(values)
+		cursor.execute('UPDATE jobs SET lsf_state = ?, lsf_state2 = ?, return_values = COALESCE(?, return_values), status = ? WHERE job_id = ? AND status = \'LAUNCHED\'', (state, state2, values, status, jobID))
+		if status == 'ERROR':
+			cursor.execute('UPDATE jobs SET finished = datetime(\'now\') WHERE job_id = ?', (jobID,))
+
 def mark_job_status2(cursor, jobID, status):
-	cursor.execute('UPDATE jobs SET status = \'%s\' WHERE job_id = \'%s\'' % (status, jobID))
+	cursor.execute('UPDATE jobs SET status = ?, finished = datetime(\'now\') WHERE job_id = ?', (status, jobID))
 
 def mark_job_status(db, jobID, status):
-	conn = sqlite3.connect(db)
-	cursor = conn.cursor()
-	mark_job_status2(cursor, jobID, status)
-	conn.commit()
-	conn.close()
+	wiggledb.wiggleDB_storage.run(db, mark_job_status2, jobID, status)
 
-def query_result(cursor, jobID, batch_system):
-	reports = cursor.execute('SELECT status, lsf_id, lsf_id2 FROM jobs WHERE job_id =?', (jobID,)).fetchall()
+def query_result(cursor, jobID):
+	# Only reads the jobs table, the batch system is queried by update_job_statuses
+	reports = cursor.execute('SELECT status, lsf_id, lsf_id2, return_values FROM jobs WHERE job_id =?', (jobID,)).fetchall()
 
 	if len(reports) == 0:
 		return {'ID':jobID, 'status':'UNKNOWN'}
 	else:
 		assert len(reports) == 1, 'Found %i status reports for job %s' % (len(reports), jobID)
 
-	status, lsfID, lsfID2 = reports[0]
+	status, lsfID, lsfID2, values = reports[0]
 	if status == 'DONE':
 		return {'ID':jobID, 'status':'DONE', 'location':get_job_location_2(cursor, jobID)}
 	elif status == 'EMPTY':
 		return {'ID':jobID, 'status':'EMPTY'}
-	elif status == 'ERROR' or lsfID is None or lsfID2 is None:
-		return {'ID':jobID, 'status':'ERROR'}
-	elif batch_system == 'LSF':
-		p = subprocess.Popen(['bjobs','-noheader',str(lsfID2)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-		ret = p.wait()
-		(stdout, stderr) = p.communicate()
-		assert ret == 0, 'Error when polling LSF job %i' % lsfID2
-		values = []
-		for line in stdout.split('\n'):
-			items = re.split('\W*', line)
-			if len(items) > 2:
-				values.append(items[2])
-		return {'ID':jobID, 'status':"WAITING", 'return_values':values}
-	elif batch_system == 'SGE':
-		if sge_job_running(lsfID2):
-			if sge_job_running(lsfID):
-				return {'ID':jobID, 'status':"WAITING", 'LSF_ID':lsfID}
-			else:
-				values = sge_job_return_values(lsfID)
-				if any(X != '0' for X in values):
-					mark_job_status2(cursor, jobID, 'ERROR')
-					return {'ID':jobID, 'status':"ERROR", 'return_values':values, 'LSF_ID':lsfID}
-				else:
-					return {'ID':jobID, 'status':"WAITING", 'LSF_ID':lsfID}
+	elif status == 'QUEUED':
+		return {'ID':jobID, 'status':'QUEUED'}
+	elif status == 'ERROR':
+		if values is not None:
+			return {'ID':jobID, 'status':'ERROR', 'return_values':json.loads(values)}
 		else:
-			values = sge_job_return_values(lsfID2)
-			if any(X != '0' for X in values):
-				mark_job_status2(cursor, jobID, 'ERROR')
-				return {'ID':jobID, 'status':"ERROR", 'return_values':values, 'LSF_ID':lsfID2}
-			else:
-				return {'ID':jobID, 'status':"WAITING", 'LSF_ID':lsfID}
-			  
+			return {'ID':jobID, 'status':'ERROR'}
+	elif values is not None:
+		return {'ID':jobID, 'status':"WAITING", 'return_values':json.loads(values), 'LSF_ID':lsfID}
 	else:
-		raise NameError
-		return {'ID':jobID, 'status':'CONFIG_ERROR'}
+		return {'ID':jobID, 'status':"WAITING", 'LSF_ID':lsfID}
 
 ###########################################
-## When a job finishes:
+## Plots
+###########################################
+
+# Plots drawn by wiggletools.wigglePlots, the others are only available as data
+RENDERED_PLOTS = ['histogram', 'overlaps']
+
+def get_plot(cursor, jobID):
+	return cursor.execute('SELECT location, plot, labels FROM cache WHERE job_id = ? AND primary_loc = 1', (jobID,)).fetchone()
+
+def get_plot_type(cursor, jobID):
+	plot = get_plot(cursor, jobID)
+	if plot is None:
+		return None
+	return plot[1]
+
+def parse_plot_value(value):
+	try:
+		return float(value)
+	except ValueError:
+		return value
+
+def read_plot_data(location):
+	file = open(location)
+	rows = [[parse_plot_value(X) for X in line.split()] for line in file if len(line.strip()) > 0 and line[0] != '#']
+	file.close()
+	return rows
+
+# Table behind the plot of a finished job, for the GUI to draw
+def plot_data(cursor, jobID):
+	res = query_result(cursor, jobID)
+	if res['status'] != 'DONE':
+		return res
+	plot = get_plot(cursor, jobID)
+	if plot is None or plot[1] is None:
+		return {'ID':jobID, 'status':'INVALID'}
+	location, plot, labels = plot
+	return {'ID':jobID, 'status':'DONE', 'plot':plot, 'labels':json.loads(labels), 'rows':read_plot_data(location)}
+
+# Whether the result has an image: drawn by the finish job, or by the query service when first opened
+def has_plot_image(cursor, jobID, location, config):
+	return get_plot_type(cursor, jobID) in RENDERED_PLOTS and ('result_url' in config or os.path.exists(location + '.png'))
+
+# Draws the plot next to the data. The plotting libraries are slow to import, so with
+# result_url set the query service draws it when first requested. Without the service,
+# the finish job draws it.
+def render_plot(location, plot, labels):
+	import wiggletools.wigglePlots
+	assert plot in RENDERED_PLOTS, 'No image for %s plots' % plot
+	fh, temp = tempfile.mkstemp(suffix='.png', dir=os.path.dirname(location))
+	os.close(fh)
+	try:
+		if plot == 'histogram':
+			wiggletools.wigglePlots.make_histogram(location, labels, temp, format='png')
+		else:
+			wiggletools.wigglePlots.make_overlaps(location, temp, format='png')
+		os.chmod(temp, 0644)
+		os.rename(temp, location + '.png')
+	except:
+		os.remove(temp)
+		raise
+
 ###########################################
+## Statistics
+###########################################
+
+def log_request(cursor, key, jobID, outcome):
+	cursor.execute('INSERT INTO request_log (time, query_hash, job_id, outcome) VALUES (datetime(\'now\'), ?, ?, ?)', (key, jobID, outcome))
+
+def record_job_stage2(cursor, jobID, stage, output_bytes=None):
+	assert stage in JOB_STAGES, 'Unknown job stage %s' % stage
+	cursor.execute('UPDATE jobs SET %s = datetime(\'now\'), output_bytes = COALESCE(?, output_bytes) WHERE job_id = ?' % stage, (output_bytes, jobID))
+
+def record_job_stage(db, jobID, stage, output_bytes=None):
+	wiggledb.wiggleDB_storage.run(db, record_job_stage2, jobID, stage, output_bytes)
+
+# Name, first and last timestamp of each measured interval in the life of a job
+JOB_INTERVALS = [
+	('submission', 'submitted', 'launched'), 
+	('compute', 'launched', 'compute_finished'), 
+	('finish', 'compute_finished', 'upload_started'), 
+	('upload', 'upload_started', 'uploaded'), 
+	('email', 'uploaded', 'emailed'), 
+	('total', 'submitted', 'finished')
+]
+
+# Each metric is a name, type, description and list of (suffix, labels, value) samples
+def get_statistics(cursor):
+	metrics = []
+
+	outcomes = cursor.execute('SELECT outcome, COUNT(*) FROM request_log GROUP BY outcome').fetchall()
+	metrics.append(('wiggledb_requests_total', 'counter', 'Compute requests by cache outcome', [('', {'outcome':X[0].lower()}, X[1]) for X in outcomes]))
+	lookups = sum(X[1] for X in outcomes if X[0] != 'INVALID')
+	if lookups > 0:
+		hits = sum(X[1] for X in outcomes if X[0] in ['HIT', 'ATTACHED'])
+		metrics.append(('wiggledb_cache_hit_ratio', 'gauge', 'Fraction of valid requests served by an existing job', [('', {}, float(hits) / lookups)]))
+
+	statuses = cursor.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+	metrics.append(('wiggledb_jobs', 'gauge', 'Jobs in the database by status', [('', {'status':X[0]}, X[1]) for X in statuses]))
+
+	samples = []
+	for name, start, end in JOB_INTERVALS:
+		total, count = cursor.execute('SELECT SUM((julianday(%s) - julianday(%s)) * 86400), COUNT(*) FROM jobs WHERE %s IS NOT NULL AND %s IS NOT NULL' % (end, start, start, end)).fetchone()
+		samples.append(('_sum', {'stage':name}, total or 0))
+		samples.append(('_count', {'stage':name}, count))
+	metrics.append(('wiggledb_job_stage_seconds', 'summary', 'Time spent by jobs in the database in each stage, compute includes queueing', samples))
+
+	input_bytes, output_bytes = cursor.execute('SELECT SUM(input_bytes), SUM(output_bytes) FROM jobs').fetchone()
+	metrics.append(('wiggledb_job_input_bytes', 'gauge', 'Bytes of local input datasets read by jobs in the database', [('', {}, input_bytes or 0)]))
+	metrics.append(('wiggledb_job_output_bytes', 'gauge', 'Bytes of results written by jobs in the database', [('', {}, output_bytes or 0)]))
+
+	entries, size = cursor.execute('SELECT COUNT(*), SUM(size) FROM cache').fetchone()
+	metrics.append(('wiggledb_cache_entries', 'gauge', 'Cached results and partial results', [('', {}, entries)]))
+	metrics.append(('wiggledb_cache_bytes', 'gauge', 'Known size of cached results', [('', {}, size or 0)]))
+
+	messages = cursor.execute('SELECT status, COUNT(*) FROM outbox GROUP BY status').fetchall()
+	metrics.append(('wiggledb_outbox_messages', 'gauge', 'E-mails in the outbox by status', [('', {'status':X[0]}, X[1]) for X in messages]))
+	return metrics
+
+def format_statistics(metrics):
+	# Prometheus text exposition format
+	lines = []
+	for name, type, description, samples in metrics:
+		lines.append('# HELP %s %s' % (name, description))
+		lines.append('# TYPE %s %s' % (name, type))
+		for suffix, labels, value in samples:
+			if len(labels) > 0:
+				lines.append('%s%s{%s} %s' % (name, suffix, ",".join('%s="%s"' % (X, labels[X]) for X in sorted(labels)), value))
+			else:
+				lines.append('%s%s %s' % (name, suffix, value))
+	return "\n".join(lines) + "\n"
 
-def send_SMTP(msg, emails, config):
-	import smtplib
-	s = smtplib.SMTP(config['smtp_server'], config['smtp_port'])
-        s.ehlo()
-        s.starttls()
-        s.ehlo()
-        s.login(config['user'], config['password'])
-	s.sendmail(config['reply_to'], emails, msg.as_string())
-	s.quit()
+###########################################
+## When a job finishes:
+###########################################
 
-def send_email(text, title, emails, config):
+# Messages are only queued here, wiggleDB_mailer.py delivers them
+def send_email(cursor, text, title, emails, config, jobID=None, stage=None):
 	from email.mime.text import MIMEText
 	msg = MIMEText(text, 'html')
 	msg['Subject'] = '[WiggleTools] ' + title
 	msg['From'] = config['reply_to']
 	msg['To'] = ", ".join(emails)
         msg['sendername'] = config['sendername']
-	send_SMTP(msg, emails, config)
+	cursor.execute('INSERT INTO outbox (job_id, stage, sender, recipients, message, status, created, next_attempt) VALUES (?, ?, ?, ?, ?, \'QUEUED\', datetime(\'now\'), datetime(\'now\'))', (jobID, stage, config['reply_to'], json.dumps(emails), msg.as_string()))
 
 def visible_url(location, config):
-	if 's3_bucket' in config:
+	if 'result_url' in config:
+		# Served by wiggleDB_server.py as soon as the job is done
+		return re.sub(config['working_directory'], config['result_url'], location)
+	elif 's3_bucket' in config and 's3_endpoint' in config:
+		base_url = '%s/%s/' % (config['s3_endpoint'].rstrip('/'), config['s3_bucket'])
+		return re.sub(config['working_directory'], base_url, location)
+	elif 's3_bucket' in config:
 		base_url = 'http://s3-%s.amazonaws.com/%s/' % (config['s3_region'], config['s3_bucket'])
 		return re.sub(config['working_directory'], base_url, location)		
 	else:
@@ -687,7 +2496,7 @@ def job_description(options):
 	text += "</table>"
 	return text	
 
-def report_to_user(options, config):
+def report_to_user(cursor, options, config):
 	if options.emails is None:
 		return
 	else:
@@ -707,13 +2516,15 @@ def report_to_user(options, config):
 		if url[-3:] == '.bw' or url[-3:] == ".bb":
 			ensembl_link = 'http://%s/%s/Location/View?g=%s;contigviewbottom=url:%s' % (config['ensembl_server'], config['ensembl_species'], config['ensembl_gene'], url)
 			text += ", or you can view them directly on <a href=%s>Ensembl</a>" % ensembl_link
-		else:
+		elif has_plot_image(cursor, options.jobID, options.data, config):
 			text += ".</p><p>"
 			text += "<center>"
 			text += "<a href='%s.png'>" % url
 			text += "<img src='%s.png'>" % url
 			text += "</a>"
 			text += "</center>"
+		else:
+			text += "."
 		text += "</p>"
 		text += job_description(options)
 		text += "<p>"
@@ -724,10 +2535,10 @@ def report_to_user(options, config):
 		text += "<p>"
 		text += "</body>"
 		text += "<html>"
-		send_email(text, 'Job %i succeeded' % options.jobID, options.emails, config)
+		send_email(cursor, text, 'Job %i succeeded' % options.jobID, options.emails, config, options.jobID, 'emailed')
 
-def acknowledge_job_to_user(options, config):
-	if options.emails is None:
+def acknowledge_job_to_user(cursor, options, config):
+	if options.emails is None or not getattr(options, 'acknowledge', True):
 		return
 	else:
 		text = "<html>"
@@ -750,9 +2561,38 @@ def acknowledge_job_to_user(options, config):
 		text += "<p>"
 		text += "</body>"
 		text += "</html>"
-		send_email(text, 'Job %i dispatched' % options.jobID, options.emails, config)
+		send_email(cursor, text, 'Job %i dispatched' % options.jobID, options.emails, config)
 
-def report_empty_to_user(options, config):
+def acknowledge_batch_to_user(cursor, options, manifest, config, batch):
+	emails = manifest.get('emails', options.emails)
+	if emails is None:
+		return
+	else:
+		text = "<html>"
+		text += "<head>"
+		text += "</head>"
+		text += "<body>"
+		text += "<p>"
+		text += "Hello"
+		text += "</p>"
+		text += "<p>"
+		text += "Your batch %i of %i queries has been despatched, each new job will e-mail its results when it completes. The jobs of its queries are:" % (batch['batch'], len(batch['queries']))
+		text += "</p>"
+		text += "<p>"
+		text += ", ".join(str(X.get('ID', X['status'])) for X in batch['queries'])
+		text += "</p>"
+		text += "<p>"
+		text += "Best regards,"
+		text += "</p>"
+		text += "<p>"
+		text += "</p>"
+		text += "The WiggleTools team"
+		text += "<p>"
+		text += "</body>"
+		text += "</html>"
+		send_email(cursor, text, 'Batch %i dispatched' % batch['batch'], emails, config)
+
+def report_empty_to_user(cursor, options, config):
 	if options.emails is None:
 		return
 	else:
@@ -776,7 +2616,36 @@ def report_empty_to_user(options, config):
 		text += "<p>"
 		text += "</body>"
 		text += "</html>"
-		send_email(text, 'Job %i returned an empty result' % options.jobID, options.emails, config)
+		send_email(cursor, text, 'Job %i returned an empty result' % options.jobID, options.emails, config, options.jobID, 'emailed')
+
+###########################################
+## Outbox
+###########################################
+
+# Due messages, held back from other mailers until they are marked sent or failed
+def claim_emails(cursor, count, lease):
+	messages = cursor.execute('SELECT message_id, sender, recipients, message FROM outbox WHERE status = \'QUEUED\' AND next_attempt <= datetime(\'now\') ORDER BY message_id LIMIT ?', (count,)).fetchall()
+	cursor.executemany('UPDATE outbox SET next_attempt = datetime(\'now\', ?) WHERE message_id = ?', [('+%i seconds' % lease, X[0]) for X in messages])
+	return [(X[0], X[1], json.loads(X[2]), X[3]) for X in messages]
+
+def mark_email_sent(cursor, messageID):
+	cursor.execute('UPDATE outbox SET status = \'SENT\', sent = datetime(\'now\'), attempts = attempts + 1 WHERE message_id = ?', (messageID,))
+	jobID, stage = cursor.execute('SELECT job_id, stage FROM outbox WHERE message_id = ?', (messageID,)).fetchone()
+	if stage is not None:
+		record_job_stage2(cursor, jobID, stage)
+
+# Messages claimed but not tried give back their lease, without counting an attempt
+def release_email(cursor, messageID):
+	cursor.execute('UPDATE outbox SET next_attempt = datetime(\'now\') WHERE message_id = ?', (messageID,))
+
+# Tried again later with exponential backoff, unless the failure is permanent or there were too many attempts
+def mark_email_failed(cursor, messageID, error, permanent=False, retries=MAIL_RETRIES):
+	attempts = cursor.execute('SELECT attempts FROM outbox WHERE message_id = ?', (messageID,)).fetchone()[0] + 1
+	if permanent or attempts >= retries:
+		cursor.execute('UPDATE outbox SET status = \'FAILED\', attempts = ?, error = ? WHERE message_id = ?', (attempts, error, messageID))
+	else:
+		delay = MAIL_RETRY_DELAY * 2 ** (attempts - 1)
+		cursor.execute('UPDATE outbox SET attempts = ?, error = ?, next_attempt = datetime(\'now\', ?) WHERE message_id = ?', (attempts, error, '+%i seconds' % delay, messageID))
 
 ###########################################
 ## Main
@@ -784,7 +2653,7 @@ def report_empty_to_user(options, config):
 
 def main():
 	options, config = get_options()
-	conn = sqlite3.connect(options.db)
+	conn = wiggledb.wiggleDB_storage.connect(options.db)
 	cursor = conn.cursor()
 
 	if config is None or 'batch_system' not in config:
@@ -794,23 +2663,58 @@ def main():
 
 	if options.load is not None:
 		create_database(cursor, options.load)
+		set_journal_mode(conn, config)
+		write_snapshot(cursor)
+	elif options.update is not None:
+		added, removed, updated = update_dataset_table(cursor, options.update)
+		# Readers only pick up the new snapshot once the new catalog version is committed
+		conn.commit()
+		write_snapshot(cursor)
+		if options.invalidate is not None:
+			invalidate_cache(conn, cursor, options.invalidate + removed + updated + changed_inputs(cursor))
+	elif options.upgrade:
+		upgrade_database(cursor)
+		set_journal_mode(conn, config)
+		write_snapshot(cursor)
 	elif options.load_assembly is not None:
 		load_assembly(cursor, options.load_assembly[0], options.load_assembly[1])
 	elif options.clean is not None:
 		clean_database(cursor, options.clean)
+	elif options.evict is not None:
+		assert options.working_directory is not None, 'No working directory specified'
+		if options.evict == 'config':
+			assert config is not None and 'cache_budget' in config, 'No cache_budget in the configuration file'
+			budget = parse_size(config['cache_budget'])
+		else:
+			budget = parse_size(options.evict)
+		evict_cache(conn, cursor, options.working_directory, budget)
 	elif options.result is not None:
-		print json.dumps(query_result(cursor, options.result, batch_system))
+		print json.dumps(query_result(cursor, options.result))
+	elif options.batch_result is not None:
+		print json.dumps(batch_result(cursor, options.batch_result))
+	elif options.batch is not None:
+		print json.dumps(request_batch(conn, cursor, options, json.load(open(options.batch)), config, batch_system))
+	elif options.retry is not None:
+		retry_local_job(cursor, options.retry)
+	elif options.poll:
+		update_job_statuses(cursor, batch_system_poller(batch_system))
+		conn.commit()
+		dispatch_queued_jobs(conn, cursor, config or dict(), batch_system)
 	elif options.cache:
 		for entry in cursor.execute('SELECT * FROM cache').fetchall():
 			print entry
+	elif options.invalidate is not None:
+		if len(options.invalidate) == 0:
+			invalidate_cache(conn, cursor, changed_inputs(cursor))
+		else:
+			invalidate_cache(conn, cursor, options.invalidate)
 	elif options.clear_cache is not None:
 		if len(options.clear_cache) == 0:
-			cursor.execute('DROP TABLE cache')
-			create_cache(cursor)
-			cursor.execute('DROP TABLE jobs')
-			create_job_table(cursor)
+			clear_cache(cursor)
 		else:
 			remove_jobs(cursor, options.clear_cache)
+	elif options.stats:
+		sys.stdout.write(format_statistics(get_statistics(cursor)))
 	elif options.attributes:
 		print json.dumps(get_attribute_values(cursor))
 	elif options.jobs is not None:
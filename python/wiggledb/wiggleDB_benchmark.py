@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+# Copyright [1999-2016] EMBL-European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import os.path
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import wiggledb.wiggleDB
+import wiggledb.wiggleDB_server
+import wiggledb.wiggleDB_storage
+
+ASSEMBLY = 'bench'
+
+###########################################
+## Command line interface
+###########################################
+
+def get_options():
+	parser = argparse.ArgumentParser(description='WiggleDB benchmarks on synthetic catalogs. Jobs are queued on the LOCAL batch system and never run.')
+	parser.add_argument('--rows','-n',dest='rows',help='Catalog sizes to benchmark',type=int,nargs='*',default=[1000, 10000, 100000])
+	parser.add_argument('--attributes','-a',dest='attributes',help='Number of attribute columns besides the mandatory ones',type=int,default=3)
+	parser.add_argument('--cardinality','-k',dest='cardinality',help='Number of distinct values per attribute',type=int,default=20)
+	parser.add_argument('--inputs','-i',dest='inputs',help='Number of stand-in input files actually written to disk',type=int,default=100)
+	parser.add_argument('--repeats','-r',dest='repeats',help='Number of timed calls per benchmark',type=int,default=20)
+	parser.add_argument('--seed',dest='seed',help='Random seed',type=int,default=0)
+	parser.add_argument('--directory','-d',dest='directory',help='Scratch directory, kept after the run if given')
+	parser.add_argument('--output','-o',dest='output',help='JSON output file, defaults to stdout')
+	parser.add_argument('--compare','-c',dest='compare',help='JSON output of a previous run, to print the ratio of median times')
+	return parser.parse_args()
+
+###########################################
+## Synthetic data
+###########################################
+
+def attribute_names(count):
+	return ['attr%i' % X for X in range(count)]
+
+def write_inputs(directory, count):
+	# Stand-ins only need to exist with distinct sizes for file identities, they are never read
+	inputs = os.path.join(directory, 'inputs')
+	os.makedirs(inputs)
+	for index in range(count):
+		if index % 10 == 0:
+			file = open(os.path.join(inputs, 'ds%i.bb' % index), 'w')
+			file.write('1\t%i\t%i\n' % (index, index + 100))
+		else:
+			file = open(os.path.join(inputs, 'ds%i.bw' % index), 'w')
+			file.write('1\t%i\t%i\t1.0\n' % (index, index + 100))
+		file.close()
+	return inputs
+
+def write_catalog(filename, inputs, rows, attributes, cardinality, rand):
+	file = open(filename, 'w')
+	file.write("\t".join(['location', 'name', 'type', 'annotation', 'assembly'] + attribute_names(attributes)) + "\n")
+	for index in range(rows):
+		# One dataset in ten is a set of regions, one in a hundred an annotation
+		if index % 10 == 0:
+			location = os.path.join(inputs, 'ds%i.bb' % index)
+			type = 'regions'
+		else:
+			location = os.path.join(inputs, 'ds%i.bw' % index)
+			type = 'signal'
+		annotation = int(index % 100 == 0)
+		values = ['v%i' % rand.randrange(cardinality) for X in range(attributes)]
+		file.write("\t".join([location, 'ds%i' % index, type, str(annotation), ASSEMBLY] + values) + "\n")
+	file.close()
+
+def write_chrom_sizes(filename):
+	file = open(filename, 'w')
+	for index in range(1, 23):
+		file.write('%i\t%i\n' % (index, 1000000 * (50 - index)))
+	file.close()
+
+def write_config(filename, directory, database):
+	file = open(filename, 'w')
+	file.write('database_location\t%s\n' % database)
+	file.write('working_directory\t%s\n' % directory)
+	file.write('batch_system\tLOCAL\n')
+	file.close()
+	return wiggledb.wiggleDB.read_config_file(filename)
+
+def random_selection(rand, attributes, cardinality):
+	# One or two values of one or two attributes, among signal tracks
+	params = {'type': ['signal']}
+	for attribute in rand.sample(attribute_names(attributes), min(attributes, rand.randint(1, 2))):
+		params[attribute] = ['v%i' % X for X in rand.sample(range(cardinality), min(cardinality, rand.randint(1, 2)))]
+	return params
+
+###########################################
+## Timing
+###########################################
+
+def time_calls(function, repeats):
+	times = []
+	for index in range(repeats):
+		start = time.time()
+		function(index)
+		times.append(time.time() - start)
+	times.sort()
+	return {'repeats':repeats, 'min':times[0], 'median':times[len(times) / 2], 'mean':sum(times) / len(times), 'max':times[-1]}
+
+def compute_options(config, config_file, working_directory, params):
+	options = wiggledb.wiggleDB_server.WiggleDBOptions(config, config_file)
+	options.assembly = ASSEMBLY
+	options.wa = 'mean'
+	options.a = params
+	options.fun_merge = None
+	options.working_directory = working_directory
+	return options
+
+def benchmark_catalog(options, directory, inputs, rows):
+	rand = random.Random(options.seed)
+	results = dict()
+	catalog = os.path.join(directory, 'datasets_%i.tsv' % rows)
+	write_catalog(catalog, inputs, rows, options.attributes, options.cardinality, rand)
+	database = os.path.join(directory, 'database_%i.sqlite3' % rows)
+	working_directory = os.path.join(directory, 'work_%i' % rows)
+	os.makedirs(working_directory)
+	config_file = os.path.join(directory, 'wiggletools_%i.conf' % rows)
+	config = write_config(config_file, working_directory, database)
+
+	conn = wiggledb.wiggleDB_storage.connect(database)
+	cursor = conn.cursor()
+	def create(index):
+		wiggledb.wiggleDB.create_database(cursor, catalog)
+		conn.commit()
+	results['create_database'] = time_calls(create, 1)
+	# Selections below use the snapshot when numpy is installed, SQL otherwise
+	results['write_snapshot'] = time_calls(lambda X: wiggledb.wiggleDB.write_snapshot(cursor), 1)
+	chrom_sizes = os.path.join(directory, 'chrom.sizes')
+	wiggledb.wiggleDB.load_assembly(cursor, ASSEMBLY, chrom_sizes)
+	conn.commit()
+
+	selections = [random_selection(rand, options.attributes, options.cardinality) for X in range(options.repeats)]
+	results['get_dataset_locations'] = time_calls(lambda X: wiggledb.wiggleDB.get_dataset_locations(cursor, dict(selections[X]), ASSEMBLY), options.repeats)
+	results['count_datasets'] = time_calls(lambda X: wiggledb.wiggleDB.count_datasets(cursor, dict(selections[X]), ASSEMBLY), options.repeats)
+	results['get_attribute_values'] = time_calls(lambda X: wiggledb.wiggleDB.get_attribute_values(cursor), options.repeats)
+
+	# Each new selection is a cache miss, queued on the local batch system
+	def request(index):
+		wiggledb.wiggleDB.request_compute(conn, cursor, compute_options(config, config_file, working_directory, dict(selections[index])), config, 'LOCAL')
+		conn.commit()
+	results['request_compute_miss'] = time_calls(request, options.repeats)
+	results['request_compute_hit'] = time_calls(request, options.repeats)
+
+	keys = [X[0] for X in cursor.execute('SELECT query_hash FROM cache').fetchall()]
+	locations = [wiggledb.wiggleDB.get_dataset_locations(cursor, dict(X), ASSEMBLY) for X in selections]
+	results['cache_key'] = time_calls(lambda X: wiggledb.wiggleDB.cache_key('mean', locations[X]), options.repeats)
+	results['get_precomputed_jobID'] = time_calls(lambda X: wiggledb.wiggleDB.get_precomputed_jobID(cursor, keys[X % len(keys)]), options.repeats)
+	results['get_precomputed_location'] = time_calls(lambda X: wiggledb.wiggleDB.get_precomputed_location(cursor, keys[X % len(keys)]), options.repeats)
+	results['plan_reduction'] = time_calls(lambda X: wiggledb.wiggleDB.plan_reduction(cursor, 'mean', locations[X]), options.repeats)
+	conn.commit()
+	conn.close()
+
+	return {'rows':rows, 'attributes':options.attributes, 'cardinality':options.cardinality, 'results':results}
+
+def compare_reports(previous, report):
+	before = dict((X['rows'], X['results']) for X in previous['catalogs'])
+	for catalog in report['catalogs']:
+		if catalog['rows'] not in before:
+			continue
+		for name in sorted(catalog['results']):
+			if name in before[catalog['rows']] and before[catalog['rows']][name]['median'] > 0:
+				ratio = catalog['results'][name]['median'] / before[catalog['rows']][name]['median']
+				sys.stderr.write('%i\t%s\t%.3f\n' % (catalog['rows'], name, ratio))
+
+def git_revision():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=open(os.devnull, 'w')).strip()
+	except Exception:
+		return None
+
+###########################################
+## Main
+###########################################
+
+def main():
+	options = get_options()
+	if options.directory is None:
+		directory = tempfile.mkdtemp()
+	else:
+		directory = options.directory
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+
+	try:
+		inputs = write_inputs(directory, options.inputs)
+		write_chrom_sizes(os.path.join(directory, 'chrom.sizes'))
+		report = {'revision':git_revision(), 'time':time.strftime('%Y-%m-%dT%H:%M:%S'), 'python':sys.version.split()[0], 'catalogs':[]}
+		for rows in options.rows:
+			report['catalogs'].append(benchmark_catalog(options, directory, inputs, rows))
+	finally:
+		if options.directory is None:
+			shutil.rmtree(directory)
+
+	if options.output is None:
+		print json.dumps(report, indent=4, sort_keys=True)
+	else:
+		file = open(options.output, 'w')
+		json.dump(report, file, indent=4, sort_keys=True)
+		file.close()
+
+	if options.compare is not None:
+		compare_reports(json.load(open(options.compare)), report)
+
+if __name__ == "__main__":
+	main()
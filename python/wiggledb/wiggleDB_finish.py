@@ -20,9 +20,10 @@ import os
 import os.path
 import json
 
-import wiggleDB.wiggleDB
+import wiggledb.wiggleDB
+import wiggledb.wiggleDB_storage
+import wiggledb.wiggleDB_upload
 import wiggletools.multiJob 
-import wiggletools.wigglePlots
 
 class Struct(object):
         def __init__(self, **entries):
@@ -31,51 +32,55 @@ class Struct(object):
 def get_options():
 	assert len(sys.argv) == 2
 	options = Struct(**(json.load(open(sys.argv[-1]))))
-	return options, wiggleDB.wiggleDB.read_config_file(options.config)
+	return options, wiggledb.wiggleDB.read_config_file(options.config)
 
 def copy_to_longterm(data, config):
 	if 's3_bucket' in config:
-		os.environ['AWS_CONFIG_FILE'] = config['aws_config']
-		cmd = "aws s3 cp %s s3://%s/%s --acl public-read" % (data, config['s3_bucket'], os.path.basename(data))
-		if subprocess.call(cmd, shell=True) != 0:
+		files = [X for X in wiggledb.wiggleDB.result_files(data) if X != data + '.empty']
+		try:
+			wiggledb.wiggleDB_upload.upload_files(config, files)
+		except Exception as error:
 			print "Failed to copy over results"
-			print cmd
+			print error
 			sys.exit(100)
 
 def main():
 	try:
 		options, config = get_options()
+		wiggledb.wiggleDB.record_job_stage(options.db, options.jobID, 'compute_finished')
 		empty = os.path.exists(options.data + ".empty")
 
-		# Optional graphics
+		# Data behind the optional graphics, which are drawn on request
 		if options.histogram is not None:
 			if subprocess.call("wiggletools "  + options.histogram, shell=True):
 				print "Failed to construct histogram"
 				sys.exit(1)
-			if os.path.getsize(options.data) > 0:
-				wiggletools.wigglePlots.make_histogram(options.data, options.labels, options.data + ".png", format='png')
-			else:
+			if os.path.getsize(options.data) == 0:
 				empty = True
 
 		if options.apply_paste is not None:
 			if subprocess.call("wiggletools "  + options.apply_paste, shell=True):
 				print "Failed to construct overlap graph"
 				sys.exit(1)
-			if os.path.getsize(options.data) > 0:
-				wiggletools.wigglePlots.make_overlaps(options.data, options.data + ".png", format='png')
-			else:
+			if os.path.getsize(options.data) == 0:
 				empty = True
 
+		# Without the query service to draw images on request, they are drawn now
+		if 'result_url' not in config and not empty and getattr(options, 'plot', None) in wiggledb.wiggleDB.RENDERED_PLOTS:
+			wiggledb.wiggleDB.render_plot(options.data, options.plot, options.labels)
+
 		# Signing off
+		output_bytes = sum(os.path.getsize(X) for X in wiggledb.wiggleDB.result_files(options.data))
+		wiggledb.wiggleDB.record_job_stage(options.db, options.jobID, 'upload_started', output_bytes)
 		if empty:
-			wiggleDB.wiggleDB.report_empty_to_user(options, config)
-			wiggleDB.wiggleDB.mark_job_status(options.db, options.jobID, 'EMPTY')
+			wiggledb.wiggleDB.record_job_stage(options.db, options.jobID, 'uploaded')
+			wiggledb.wiggleDB_storage.run(options.db, wiggledb.wiggleDB.report_empty_to_user, options, config)
+			wiggledb.wiggleDB.mark_job_status(options.db, options.jobID, 'EMPTY')
 		else:
 			copy_to_longterm(options.data, config)
-			if os.path.exists(options.data + ".png"):
-				copy_to_longterm(data + ".png", config)
-			wiggleDB.wiggleDB.report_to_user(options, config)
-			wiggleDB.wiggleDB.mark_job_status(options.db, options.jobID, 'DONE')
+			wiggledb.wiggleDB.record_job_stage(options.db, options.jobID, 'uploaded')
+			wiggledb.wiggleDB_storage.run(options.db, wiggledb.wiggleDB.report_to_user, options, config)
+			wiggledb.wiggleDB.mark_job_status(options.db, options.jobID, 'DONE')
 
 		# Housekeeping
 		if options.temps is not None:
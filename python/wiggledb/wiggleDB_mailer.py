@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+# Copyright [1999-2016] EMBL-European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import socket
+import smtplib
+import argparse
+import traceback
+
+import wiggledb.wiggleDB
+import wiggledb.wiggleDB_storage
+
+# Messages sent per batch
+MAIL_BATCH = 50
+# Seconds a claimed message is held back from other mailers
+MAIL_LEASE = 600
+# Seconds an idle SMTP connection is kept open
+MAIL_IDLE = 60
+
+def get_options():
+	parser = argparse.ArgumentParser(description='WiggleDB e-mail sender.')
+	parser.add_argument('--config','-c',dest='config',help='Configuration file',required=True)
+	parser.add_argument('--interval','-i',dest='interval',help='Seconds between two looks at the outbox',type=float)
+	parser.add_argument('--retries','-r',dest='retries',help='Number of delivery attempts per message',type=int)
+	parser.add_argument('--once',dest='once',help='Send the messages due and exit',action='store_true')
+	parser.add_argument('--verbose','-v',dest='verbose',help='Turn on status output',action='store_true')
+	options = parser.parse_args()
+	config = wiggledb.wiggleDB.read_config_file(options.config)
+	if options.interval is None:
+		options.interval = float(config.get('mail_interval', 10))
+	if options.retries is None:
+		options.retries = int(config.get('mail_retries', wiggledb.wiggleDB.MAIL_RETRIES))
+	wiggledb.wiggleDB.verbose = options.verbose
+	return options, config
+
+# One authenticated connection, reused across messages and batches
+class Mailer(object):
+	def __init__(self, config):
+		self.config = config
+		self.smtp = None
+		self.last_used = 0
+
+	def connect(self):
+		smtp = smtplib.SMTP(self.config['smtp_server'], int(self.config['smtp_port']))
+		smtp.ehlo()
+		if self.config.get('smtp_tls', 'true').lower() != 'false':
+			smtp.starttls()
+			smtp.ehlo()
+		if 'user' in self.config:
+			smtp.login(self.config['user'], self.config['password'])
+		return smtp
+
+	def close(self):
+		if self.smtp is not None:
+			try:
+				self.smtp.quit()
+			except (smtplib.SMTPException, socket.error):
+				pass
+			self.smtp = None
+
+	def send(self, sender, recipients, message):
+		if self.smtp is not None and time.time() - self.last_used > MAIL_IDLE:
+			self.close()
+		try:
+			if self.smtp is None:
+				self.smtp = self.connect()
+			self.smtp.sendmail(sender, recipients, message)
+		except smtplib.SMTPServerDisconnected:
+			# The server may have dropped a connection which looked alive, reconnect once
+			self.smtp = self.connect()
+			self.smtp.sendmail(sender, recipients, message)
+		self.last_used = time.time()
+
+def is_permanent(error):
+	# 5xx replies about this message (not the connection or login) will not get better
+	if isinstance(error, smtplib.SMTPRecipientsRefused):
+		return True
+	return isinstance(error, (smtplib.SMTPSenderRefused, smtplib.SMTPDataError)) and error.smtp_code >= 500
+
+def send_batch(db, mailer, retries):
+	messages = wiggledb.wiggleDB_storage.run(db, wiggledb.wiggleDB.claim_emails, MAIL_BATCH, MAIL_LEASE)
+	sent = []
+	failed = []
+	untried = []
+	for messageID, sender, recipients, message in messages:
+		try:
+			mailer.send(sender, recipients, message)
+			sent.append(messageID)
+		except (smtplib.SMTPException, socket.error) as error:
+			if wiggledb.wiggleDB.verbose:
+				traceback.print_exc()
+			permanent = is_permanent(error)
+			failed.append((messageID, str(error), permanent))
+			if not permanent:
+				# Leave the rest of the batch for the next attempt
+				mailer.close()
+				untried = [X[0] for X in messages[len(sent) + len(failed):]]
+				break
+
+	# Sent and failed messages are recorded together, after the SMTP exchanges
+	def record(cursor):
+		for messageID in sent:
+			wiggledb.wiggleDB.mark_email_sent(cursor, messageID)
+		for messageID, error, permanent in failed:
+			wiggledb.wiggleDB.mark_email_failed(cursor, messageID, error, permanent, retries)
+		for messageID in untried:
+			wiggledb.wiggleDB.release_email(cursor, messageID)
+	wiggledb.wiggleDB_storage.run(db, record)
+	if wiggledb.wiggleDB.verbose and len(messages) > 0:
+		print 'Sent %i e-mails, %i failed, %i left for later' % (len(sent), len(failed), len(untried))
+	# After a connection failure, wait before the next batch
+	return len(sent) + len(failed)
+
+def main():
+	options, config = get_options()
+	mailer = Mailer(config)
+	while True:
+		try:
+			if send_batch(config['database_location'], mailer, options.retries) == MAIL_BATCH:
+				continue
+		except Exception:
+			traceback.print_exc()
+		if options.once:
+			break
+		time.sleep(options.interval)
+	mailer.close()
+
+if __name__ == "__main__":
+	main()
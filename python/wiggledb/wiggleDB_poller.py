@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+# Copyright [1999-2016] EMBL-European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import argparse
+import traceback
+
+import wiggledb.wiggleDB
+import wiggledb.wiggleDB_storage
+
+def get_options():
+	parser = argparse.ArgumentParser(description='WiggleDB batch job poller.')
+	parser.add_argument('--config','-c',dest='config',help='Configuration file',required=True)
+	parser.add_argument('--interval','-i',dest='interval',help='Seconds between two polls of the batch system',type=float)
+	parser.add_argument('--verbose','-v',dest='verbose',help='Turn on status output',action='store_true')
+	options = parser.parse_args()
+	config = wiggledb.wiggleDB.read_config_file(options.config)
+	if options.interval is None:
+		options.interval = float(config.get('poll_interval', 30))
+	wiggledb.wiggleDB.verbose = options.verbose
+	return options, config
+
+def poll_once(db, poll):
+	# Only reads until the batch system has answered
+	wiggledb.wiggleDB_storage.run(db, wiggledb.wiggleDB.update_job_statuses, poll)
+
+def dispatch_once(config):
+	# Submissions to the batch system happen outside of any transaction
+	conn = wiggledb.wiggleDB_storage.connect(config['database_location'])
+	try:
+		wiggledb.wiggleDB.dispatch_queued_jobs(conn, conn.cursor(), config, config.get('batch_system', 'SGE'))
+	finally:
+		conn.close()
+
+def main():
+	options, config = get_options()
+	poll = wiggledb.wiggleDB.batch_system_poller(config.get('batch_system', 'SGE'))
+	while True:
+		try:
+			poll_once(config['database_location'], poll)
+			# Finished jobs make room for queued ones
+			dispatch_once(config)
+		except Exception:
+			# Keep polling through transient scheduler or database errors
+			traceback.print_exc()
+		time.sleep(options.interval)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,635 @@
+#!/usr/bin/env python
+
+# Copyright [1999-2016] EMBL-European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import json
+import time
+import calendar
+import email.utils
+import argparse
+import threading
+import traceback
+import urlparse
+import Queue
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer
+
+import wiggledb.wiggleDB
+import wiggledb.wiggleDB_storage
+import wiggledb.wiggleDB_upload
+
+###########################################
+## Request handling
+###########################################
+
+class WiggleDBOptions(object):
+	def __init__(self, config, config_file, debug=False):
+		self.conn = None
+		self.assembly = None
+		self.wa  = None
+		self.working_directory = None
+		self.s3 = None
+		self.wb = None
+		self.a = None
+		self.b = None
+		self.dry_run = debug
+		self.remember = False
+		self.db = config['database_location']
+		self.config = config_file
+		self.emails = None
+		self.user = None
+
+def report_result(cursor, result, config):
+	url = wiggledb.wiggleDB.visible_url(result['location'], config)
+	if result['location'][-3:] == ".bw" or result['location'][-3:] == ".bb":
+		ensembl = 'http://%s/%s/Location/View?g=%s;contigviewbottom=url:%s' % (config['ensembl_server'], config['ensembl_species'], config['ensembl_gene'], url)
+	elif wiggledb.wiggleDB.has_plot_image(cursor, result['ID'], result['location'], config):
+		ensembl = url + ".png"
+	else:
+		# Only available as data
+		return {'ID':result['ID'], 'status':result['status'], 'url':url}
+	return {'ID':result['ID'], 'status':result['status'], 'url':url, 'view':ensembl}
+
+def report_batch(cursor, result, config):
+	if 'queries' in result:
+		result['queries'] = [report_result(cursor, X, config) if X['status'] == 'DONE' else X for X in result['queries']]
+	return result
+
+def get_annotation_names(cursor, assembly, catalog=None):
+	if catalog is not None:
+		return catalog.annotations(cursor, assembly)
+	else:
+		return wiggledb.wiggleDB.get_annotation_names(cursor, assembly)
+
+def get_facet_counts(cursor, params, assembly, catalog=None):
+	if catalog is not None:
+		return wiggledb.wiggleDB.facet_counts(catalog.facet_index(cursor, assembly), params, get_facet_attributes(cursor))
+	else:
+		# Building the index would cost more than the request itself
+		return wiggledb.wiggleDB.query_facet_counts(cursor, params, assembly, get_facet_attributes(cursor))
+
+def get_facet_attributes(cursor):
+	# The attributes offered in the selection panels
+	return wiggledb.wiggleDB.get_dataset_attributes(cursor) + ['type']
+
+# The form is a dictionary of value lists, as returned by cgi.FieldStorage.getlist or urlparse.parse_qs
+# The user is the client address, used for admission control of requests without an e-mail address
+def handle_request(conn, cursor, form, config, config_file, debug=False, catalog=None, user=None):
+	if "result" in form:
+		result = wiggledb.wiggleDB.query_result(cursor, form["result"][0])
+		if result['status'] == "DONE":
+			return report_result(cursor, result, config)
+		else:
+			# With its ID, so that clients can wait on the job
+			return result
+
+	elif "count" in form:
+		assembly = form['assembly'][0]
+		params = dict((re.sub("^._", "", X), form[X]) for X in form if X != "count")
+		count = wiggledb.wiggleDB.count_datasets(cursor, params, assembly)
+		return {'query':params,'count':count}
+
+	elif 'facets' in form:
+		assembly = form['assembly'][0]
+		params = dict((re.sub("^._", "", X), form[X]) for X in form if X not in ["facets", "assembly"])
+		result = get_facet_counts(cursor, params, assembly, catalog)
+		result['query'] = params
+		return result
+
+	elif 'attributes' in form:
+		return wiggledb.wiggleDB.get_attribute_values(cursor)
+
+	elif 'plot' in form:
+		return wiggledb.wiggleDB.plot_data(cursor, int(form['plot'][0]))
+
+	elif 'wait' in form:
+		# Without a watcher thread (e.g. from the CGI script), by looking at the database now and then
+		jobID, status, timeout = wait_params(form)
+		deadline = time.time() + timeout
+		result = job_report(cursor, jobID, config)[1]
+		while result['status'] == (status or result['status']) and time.time() < deadline:
+			status = result['status']
+			conn.commit()
+			time.sleep(min(WAIT_POLL_INTERVAL, max(0, deadline - time.time())))
+			result = job_report(cursor, jobID, config)[1]
+		return result
+
+	elif 'annotations' in form:
+		assembly = form['assembly'][0]
+		return {"annotations": get_annotation_names(cursor, assembly, catalog)}
+
+	elif 'batch_result' in form:
+		return report_batch(cursor, wiggledb.wiggleDB.batch_result(cursor, int(form['batch_result'][0])), config)
+
+	elif 'batch' in form:
+		# A JSON manifest of queries, see wiggledb.wiggleDB.request_batch
+		options = WiggleDBOptions(config, config_file, debug)
+		options.user = user
+		if 'explain' in form:
+			options.dry_run = True
+		options.working_directory = config['working_directory']
+		options.s3 = config.get('s3_bucket')
+		if 'email' in form:
+			options.emails = form['email']
+		manifest = json.loads(form['batch'][0])
+		return report_batch(cursor, wiggledb.wiggleDB.request_batch(conn, cursor, options, manifest, config, config['batch_system']), config)
+
+	elif 'wa' in form:
+		options = WiggleDBOptions(config, config_file, debug)
+		options.assembly = form['assembly'][0]
+		options.wa = form['wa'][0]
+		options.user = user
+		if 'explain' in form:
+			options.dry_run = True
+		options.working_directory = config['working_directory']
+		options.s3 = config.get('s3_bucket')
+		if 'email' in form:
+			options.emails = form['email']
+
+		if 'wb' in form:
+			options.wb = form['wb'][0]
+		else:
+			options.wb = None
+
+		if 'w' in form:
+			options.fun_merge = form['w'][0]
+		else:
+			options.fun_merge = None
+
+		options.a = dict((X[2:], form[X]) for X in form if X[:2] == "A_")
+		options.b = dict((X[2:], form[X]) for X in form if X[:2] == "B_")
+		if len(options.b.keys()) == 0:
+			options.b = None
+
+		if options.b is not None and options.a.get('type') == ['regions'] and options.b.get('type') == ['signal']:
+			tmp = options.b
+			options.b = options.a
+			options.a = tmp
+
+		result = wiggledb.wiggleDB.request_compute(conn, cursor, options, config, config['batch_system'])
+		if result['status'] == 'DONE':
+			return report_result(cursor, result, config)
+		else:
+			return result
+
+	else:
+		return "No params, no output"
+
+# Prometheus text format, served instead of JSON
+STATS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+def handle_stats(cursor):
+	return wiggledb.wiggleDB.format_statistics(wiggledb.wiggleDB.get_statistics(cursor))
+
+###########################################
+## Conditional requests
+###########################################
+
+# Endpoints whose output only changes when the datasets are reloaded
+CATALOG_ENDPOINTS = ['attributes', 'annotations']
+
+def is_catalog_request(form):
+	return any(X in form for X in CATALOG_ENDPOINTS) and not any(X in form for X in ['result', 'count', 'facets', 'wa'])
+
+def catalog_headers(cursor):
+	version, modified = wiggledb.wiggleDB.get_catalog_version(cursor)
+	timestamp = calendar.timegm(time.strptime(modified, '%Y-%m-%d %H:%M:%S'))
+	# Clients may keep the catalog, but must check it is still current
+	return [('ETag', '"%s"' % wiggledb.wiggleDB.get_catalog_tag(cursor)), ('Last-Modified', email.utils.formatdate(timestamp, usegmt=True)), ('Cache-Control', 'no-cache')]
+
+# Takes the CGI or WSGI environment
+def not_modified(headers, environ):
+	headers = dict(headers)
+	if 'HTTP_IF_NONE_MATCH' in environ:
+		tags = [X.strip() for X in environ['HTTP_IF_NONE_MATCH'].split(',')]
+		return '*' in tags or headers['ETag'] in tags or 'W/' + headers['ETag'] in tags
+	elif 'HTTP_IF_MODIFIED_SINCE' in environ:
+		since = email.utils.parsedate_tz(environ['HTTP_IF_MODIFIED_SINCE'])
+		return since is not None and email.utils.mktime_tz(since) >= email.utils.mktime_tz(email.utils.parsedate_tz(headers['Last-Modified']))
+	else:
+		return False
+
+###########################################
+## Result files
+###########################################
+
+# URL path under which finished results are served from the working directory
+RESULTS_PATH = '/results/'
+# Result files never change once their job is done, a new result gets a new name
+RESULT_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+RESULT_BLOCK_SIZE = 256 * 1024
+
+# Images are drawn one at a time
+plot_lock = threading.Lock()
+
+# Location, cache key, plot type and labels of a finished result (or of its image), None if there is no such result
+def result_file(cursor, config, name):
+	if re.match('^[\w.-]+$', name) is None:
+		return None, None, None, None
+	location = os.path.join(config['working_directory'], name)
+	if location.endswith('.png'):
+		base = location[:-4]
+	else:
+		base = location
+	row = cursor.execute('SELECT cache.query_hash, jobs.status, cache.plot, cache.labels FROM cache JOIN jobs ON cache.job_id = jobs.job_id WHERE cache.location = ?', (base,)).fetchone()
+	if row is None or row[1] != 'DONE':
+		return None, None, None, None
+	if row[3] is None:
+		return location, row[0], row[2], None
+	return location, row[0], row[2], json.loads(row[3])
+
+# Draws the image of a plot the first time it is requested
+def find_plot_image(location, plot, labels):
+	if os.path.isfile(location) or not location.endswith('.png') or plot not in wiggledb.wiggleDB.RENDERED_PLOTS:
+		return
+	with plot_lock:
+		if not os.path.isfile(location) and os.path.isfile(location[:-4]) and os.path.getsize(location[:-4]) > 0:
+			wiggledb.wiggleDB.render_plot(location[:-4], plot, labels)
+
+# First and last byte of a single range, None to send the whole file, raises ValueError if unsatisfiable
+def parse_range(header, size):
+	match = re.match('^bytes=(\d*)-(\d*)$', header.strip())
+	if match is None or match.group(1) + match.group(2) == '':
+		# Several ranges are answered with the whole file
+		return None
+	if match.group(1) == '':
+		if int(match.group(2)) == 0:
+			raise ValueError('Empty suffix range')
+		return max(0, size - int(match.group(2))), size - 1
+	start = int(match.group(1))
+	if match.group(2) == '':
+		end = size - 1
+	elif int(match.group(2)) < start:
+		return None
+	else:
+		end = min(int(match.group(2)), size - 1)
+	if start >= size:
+		raise ValueError('Range starts after the end of the file')
+	return start, end
+
+def read_range(file, start, length):
+	try:
+		file.seek(start)
+		while length > 0:
+			data = file.read(min(RESULT_BLOCK_SIZE, length))
+			if len(data) == 0:
+				break
+			length -= len(data)
+			yield data
+	finally:
+		file.close()
+
+def serve_result(environ, start_response, pool, config):
+	conn = pool.get()
+	try:
+		location, key, plot, labels = result_file(conn.cursor(), config, environ['PATH_INFO'][len(RESULTS_PATH):])
+		conn.commit()
+	finally:
+		pool.put(conn)
+	if location is not None:
+		find_plot_image(location, plot, labels)
+		if not os.path.isfile(location):
+			location = None
+	cors = [('Access-Control-Allow-Origin', '*'), ('Access-Control-Expose-Headers', 'Accept-Ranges, Content-Length, Content-Range, ETag')]
+
+	if environ['REQUEST_METHOD'] == 'OPTIONS':
+		start_response('204 No Content', cors + [('Access-Control-Allow-Methods', 'GET, HEAD'), ('Access-Control-Allow-Headers', 'Range, If-None-Match, If-Range'), ('Content-Length', '0')])
+		return []
+	if location is None:
+		start_response('404 Not Found', cors + [('Content-Type', 'text/plain'), ('Content-Length', '9')])
+		return ['Not found']
+
+	size = os.path.getsize(location)
+	tag = '"%s%s"' % (str(key), os.path.splitext(location)[1])
+	headers = cors + [('ETag', tag), ('Last-Modified', email.utils.formatdate(os.path.getmtime(location), usegmt=True)), ('Cache-Control', RESULT_CACHE_CONTROL), ('Accept-Ranges', 'bytes')]
+	if not_modified(headers, environ):
+		start_response('304 Not Modified', headers)
+		return []
+
+	byte_range = None
+	if 'HTTP_RANGE' in environ and environ.get('HTTP_IF_RANGE', tag) in [tag, dict(headers)['Last-Modified']]:
+		try:
+			byte_range = parse_range(environ['HTTP_RANGE'], size)
+		except ValueError:
+			start_response('416 Range Not Satisfiable', headers + [('Content-Range', 'bytes */%i' % size), ('Content-Length', '0')])
+			return []
+	if byte_range is None:
+		status = '200 OK'
+		start, end = 0, size - 1
+	else:
+		status = '206 Partial Content'
+		start, end = byte_range
+		headers.append(('Content-Range', 'bytes %i-%i/%i' % (start, end, size)))
+	start_response(status, headers + [('Content-Type', wiggledb.wiggleDB_upload.content_type(location)), ('Content-Length', str(end - start + 1))])
+	if environ['REQUEST_METHOD'] == 'HEAD':
+		return []
+
+	file = open(location, 'rb')
+	if end == size - 1 and 'wsgi.file_wrapper' in environ:
+		# Up to the end of the file, which servers with sendfile support copy without going through Python
+		file.seek(start)
+		return environ['wsgi.file_wrapper'](file, RESULT_BLOCK_SIZE)
+	else:
+		return read_range(file, start, end - start + 1)
+
+###########################################
+## Job status notifications
+###########################################
+
+# Longest wait allowed to a client, in seconds
+WAIT_TIMEOUT = 60
+# Seconds between two looks at the database, by the watcher thread or else by each waiting request
+WATCH_INTERVAL = 0.5
+WAIT_POLL_INTERVAL = 2
+# Event streams send a comment this often to keep proxies from closing them, and end after a day
+EVENTS_KEEPALIVE = 15
+EVENTS_TIMEOUT = 24 * 3600
+FINAL_STATUSES = ['DONE', 'EMPTY', 'ERROR', 'UNKNOWN']
+
+def wait_params(form):
+	timeout = min(float(form.get('timeout', [WAIT_TIMEOUT])[0]), WAIT_TIMEOUT)
+	return int(form['wait'][0]), form.get('status', [None])[0], timeout
+
+# Status as stored in the jobs table, and as reported to users
+def job_report(cursor, jobID, config):
+	row = cursor.execute('SELECT status FROM jobs WHERE job_id = ?', (jobID,)).fetchone()
+	result = wiggledb.wiggleDB.query_result(cursor, jobID)
+	if result['status'] == 'DONE':
+		result = report_result(cursor, result, config)
+	if row is None:
+		return None, result
+	return row[0], result
+
+# One thread watches the database for all the waiting requests, which sleep without polling
+class JobWatcher(object):
+	def __init__(self, db, interval=WATCH_INTERVAL):
+		self.db = db
+		self.interval = interval
+		self.lock = threading.Lock()
+		# Job ID to list of (event, deadline, status the request saw)
+		self.waiters = dict()
+		self.statuses = dict()
+		self.fresh = False
+		self.thread = None
+
+	def start(self):
+		if self.thread is None:
+			self.thread = threading.Thread(target=self.run)
+			self.thread.daemon = True
+			self.thread.start()
+
+	# Returns when the job's status differs from the one given, or when the timeout has passed
+	def wait(self, jobID, status, timeout):
+		event = threading.Event()
+		with self.lock:
+			self.start()
+			self.waiters.setdefault(jobID, []).append((event, time.time() + timeout, status))
+			self.fresh = True
+		# Without a timeout, Python 2 blocks on a lock instead of polling
+		event.wait()
+
+	def read_statuses(self, cursor, jobs):
+		statuses = dict((X, None) for X in jobs)
+		for start in range(0, len(jobs), 500):
+			batch = jobs[start:start + 500]
+			statuses.update(cursor.execute('SELECT job_id, status FROM jobs WHERE job_id IN (%s)' % ",".join('?' for X in batch), batch).fetchall())
+		return statuses
+
+	def run(self):
+		conn = None
+		version = None
+		while True:
+			try:
+				# Opened here, so that a database which cannot be opened yet is tried again
+				if conn is None:
+					conn = wiggledb.wiggleDB_storage.connect(self.db)
+					version = None
+				with self.lock:
+					jobs = list(self.waiters)
+					fresh = self.fresh
+					self.fresh = False
+				# Changes whenever another connection commits
+				current = conn.execute('PRAGMA data_version').fetchone()[0]
+				if len(jobs) > 0 and (fresh or current != version):
+					self.statuses = self.read_statuses(conn.cursor(), jobs)
+				version = current
+				conn.commit()
+			except Exception:
+				traceback.print_exc()
+				if conn is not None:
+					conn.close()
+					conn = None
+				# Statuses may have been missed
+				with self.lock:
+					self.fresh = True
+			# Waiters are released at their deadline even when the database cannot be read
+			self.notify()
+			time.sleep(self.interval)
+
+	def notify(self):
+		now = time.time()
+		with self.lock:
+			for jobID in self.waiters.keys():
+				waiting = []
+				for event, deadline, status in self.waiters[jobID]:
+					if (jobID in self.statuses and self.statuses[jobID] != status) or now >= deadline:
+						event.set()
+					else:
+						waiting.append((event, deadline, status))
+				if len(waiting) > 0:
+					self.waiters[jobID] = waiting
+				else:
+					del self.waiters[jobID]
+					self.statuses.pop(jobID, None)
+
+def pooled_job_report(pool, jobID, config):
+	conn = pool.get()
+	try:
+		res = job_report(conn.cursor(), jobID, config)
+		conn.commit()
+		return res
+	finally:
+		pool.put(conn)
+
+# Long poll: answers once the reported status differs from the one given (by default the current one)
+def serve_wait(start_response, pool, config, watcher, form):
+	jobID, status, timeout = wait_params(form)
+	deadline = time.time() + timeout
+	raw, result = pooled_job_report(pool, jobID, config)
+	while result['status'] == (status or result['status']) and time.time() < deadline:
+		status = result['status']
+		watcher.wait(jobID, raw, deadline - time.time())
+		raw, result = pooled_job_report(pool, jobID, config)
+	body = json.dumps(result)
+	start_response('200 OK', [('Content-Type', 'application/json'), ('Content-Length', str(len(body))), ('Access-Control-Allow-Origin', '*'), ('Cache-Control', 'no-store')])
+	return [body]
+
+# Server-sent events: one status event per change, until the job is over
+def serve_events(start_response, pool, config, watcher, form):
+	jobID = int(form['events'][0])
+	start_response('200 OK', [('Content-Type', 'text/event-stream'), ('Access-Control-Allow-Origin', '*'), ('Cache-Control', 'no-store')])
+
+	def stream():
+		deadline = time.time() + EVENTS_TIMEOUT
+		sent = None
+		while time.time() < deadline:
+			raw, result = pooled_job_report(pool, jobID, config)
+			if result != sent:
+				yield 'event: status\ndata: %s\n\n' % json.dumps(result)
+				sent = result
+			if result['status'] in FINAL_STATUSES:
+				break
+			start = time.time()
+			watcher.wait(jobID, raw, EVENTS_KEEPALIVE)
+			if time.time() - start >= EVENTS_KEEPALIVE:
+				yield ': keepalive\n\n'
+	return stream()
+
+###########################################
+## Warm catalog
+###########################################
+
+# Kept until the catalog version changes
+class Catalog(object):
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.loaded = dict()
+
+	def get(self, cursor, key, load):
+		version = wiggledb.wiggleDB.get_catalog_tag(cursor)
+		with self.lock:
+			if key in self.loaded and self.loaded[key][0] == version:
+				return self.loaded[key][1]
+		value = load()
+		with self.lock:
+			self.loaded[key] = (version, value)
+		return value
+
+	def annotations(self, cursor, assembly):
+		return self.get(cursor, ('annotations', assembly), lambda: wiggledb.wiggleDB.get_annotation_names(cursor, assembly))
+
+	def facet_index(self, cursor, assembly):
+		return self.get(cursor, ('facets', assembly), lambda: wiggledb.wiggleDB.build_facet_index(cursor, assembly))
+
+	def clear(self):
+		with self.lock:
+			self.loaded = dict()
+
+###########################################
+## Connection pool
+###########################################
+
+class ConnectionPool(object):
+	def __init__(self, db):
+		self.db = db
+		self.idle = Queue.Queue()
+
+	def get(self):
+		try:
+			return self.idle.get_nowait()
+		except Queue.Empty:
+			return wiggledb.wiggleDB_storage.connect(self.db, check_same_thread=False)
+
+	def put(self, conn):
+		self.idle.put(conn)
+
+###########################################
+## WSGI application
+###########################################
+
+# Parameters of the query string and, for POST requests (e.g. long batch manifests), of the form body
+def request_form(environ):
+	form = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+	if environ['REQUEST_METHOD'] == 'POST':
+		length = int(environ.get('CONTENT_LENGTH') or 0)
+		for name, values in urlparse.parse_qs(environ['wsgi.input'].read(length)).items():
+			form.setdefault(name, []).extend(values)
+	return form
+
+def make_application(config_file):
+	config = wiggledb.wiggleDB.read_config_file(config_file)
+	debug = config.get('debug') == 'True'
+	pool = ConnectionPool(config['database_location'])
+	catalog = Catalog()
+	watcher = JobWatcher(config['database_location'])
+
+	def application(environ, start_response):
+		if environ.get('PATH_INFO', '').startswith(RESULTS_PATH):
+			return serve_result(environ, start_response, pool, config)
+		form = request_form(environ)
+		# Waiting requests do not hold a database connection
+		if 'wait' in form:
+			return serve_wait(start_response, pool, config, watcher, form)
+		if 'events' in form:
+			return serve_events(start_response, pool, config, watcher, form)
+		conn = pool.get()
+		headers = []
+		try:
+			cursor = conn.cursor()
+			content_type = 'application/json'
+			status = '200 OK'
+			if is_catalog_request(form):
+				headers = catalog_headers(cursor)
+			if 'stats' in form:
+				body = handle_stats(cursor)
+				content_type = STATS_CONTENT_TYPE
+			elif is_catalog_request(form) and not_modified(headers, environ):
+				body = ''
+				status = '304 Not Modified'
+			else:
+				body = json.dumps(handle_request(conn, cursor, form, config, config_file, debug, catalog, environ.get('REMOTE_ADDR')))
+			conn.commit()
+		except:
+			conn.rollback()
+			traceback.print_exc(file=environ['wsgi.errors'])
+			body = json.dumps("ERROR")
+			content_type = 'application/json'
+			status = '500 Internal Server Error'
+			headers = []
+		finally:
+			pool.put(conn)
+
+		start_response(status, [('Content-Type', content_type), ('Content-Length', str(len(body))), ('Access-Control-Allow-Origin', '*')] + headers)
+		return [body]
+
+	return application
+
+# For mod_wsgi, gunicorn and friends
+if 'WIGGLEDB_CONFIG' in os.environ:
+	application = make_application(os.environ['WIGGLEDB_CONFIG'])
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+	daemon_threads = True
+
+###########################################
+## Main
+###########################################
+
+def get_options():
+	parser = argparse.ArgumentParser(description='WiggleDB query service.')
+	parser.add_argument('--config','-c',dest='config',help='Configuration file',required=True)
+	parser.add_argument('--host',dest='host',help='Interface to listen on',default='')
+	parser.add_argument('--port','-p',dest='port',help='Port to listen on',type=int,default=8080)
+	return parser.parse_args()
+
+def main():
+	options = get_options()
+	server = make_server(options.host, options.port, make_application(options.config), server_class=ThreadingWSGIServer)
+	server.serve_forever()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,179 @@
+# Copyright [1999-2016] EMBL-European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import os.path
+import json
+import mmap
+import struct
+import tempfile
+import threading
+
+# File layout:
+#  MAGIC
+#  header length, as a little endian 64 bit integer
+#  JSON header: catalog version, row count, and for each column its dictionary of values
+#  padding to ALIGNMENT, then for each column one 32 bit code per row
+#  row + 1 64 bit offsets into the location strings, then the UTF-8 location strings
+# Rows are sorted by location, so selections come out sorted.
+MAGIC = 'WIGGLEDB-CATALOG-1\n'
+ALIGNMENT = 8
+
+###########################################
+## Writing
+###########################################
+
+def snapshot_location(db):
+	return db + '.catalog'
+
+def align(offset):
+	return offset + (-offset % ALIGNMENT)
+
+def encode_column(values):
+	dictionary = []
+	codes = dict()
+	column = []
+	for value in values:
+		# NULLs are kept apart, as SQL never selects them
+		if value is not None:
+			value = unicode(value)
+		if value not in codes:
+			codes[value] = len(dictionary)
+			dictionary.append(value)
+		column.append(codes[value])
+	return dictionary, struct.pack('<%iI' % len(column), *column)
+
+def write_snapshot(cursor, filename, version):
+	cursor.execute('SELECT * FROM datasets ORDER BY location')
+	attributes = [X[0] for X in cursor.description]
+	rows = cursor.fetchall()
+	columns = zip(*rows) or [()] * len(attributes)
+
+	header = {'version':version, 'rows':len(rows), 'columns':[]}
+	blocks = []
+	for attribute, values in zip(attributes, columns):
+		if attribute == 'location':
+			continue
+		dictionary, block = encode_column(values)
+		header['columns'].append({'name':attribute, 'values':dictionary})
+		blocks.append(block)
+
+	strings = [unicode(X).encode('utf-8') for X in columns[attributes.index('location')]]
+	offsets = [0]
+	for string in strings:
+		offsets.append(offsets[-1] + len(string))
+	blocks.append(struct.pack('<%iQ' % len(offsets), *offsets))
+	blocks.append(''.join(strings))
+
+	# Written next to the database then renamed, so that readers see either snapshot in full
+	file, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), prefix='.catalog')
+	try:
+		text = json.dumps(header)
+		data = MAGIC + struct.pack('<Q', len(text)) + text
+		for block in blocks:
+			data += '\0' * (align(len(data)) - len(data))
+			os.write(file, data)
+			data = block
+		os.write(file, data)
+		os.fsync(file)
+	finally:
+		os.close(file)
+	try:
+		os.chmod(temp, 0644)
+		os.rename(temp, filename)
+	except OSError:
+		os.remove(temp)
+		raise
+
+###########################################
+## Reading
+###########################################
+
+class Snapshot(object):
+	def __init__(self, filename):
+		import numpy
+		self.numpy = numpy
+		file = open(filename, 'rb')
+		try:
+			self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+		finally:
+			file.close()
+		assert self.map[:len(MAGIC)] == MAGIC, 'Not a catalog snapshot: ' + filename
+		length = struct.unpack('<Q', self.map[len(MAGIC):len(MAGIC) + 8])[0]
+		header = json.loads(self.map[len(MAGIC) + 8:len(MAGIC) + 8 + length])
+		self.version = header['version']
+		self.rows = header['rows']
+
+		# Arrays are views on the mapped pages, shared by all the processes reading the snapshot
+		offset = len(MAGIC) + 8 + length
+		self.columns = dict()
+		self.codes = dict()
+		for column in header['columns']:
+			offset = align(offset)
+			self.columns[column['name']] = numpy.frombuffer(self.map, dtype='<u4', count=self.rows, offset=offset)
+			self.codes[column['name']] = dict((value, code) for code, value in enumerate(column['values']))
+			offset += 4 * self.rows
+		offset = align(offset)
+		self.offsets = numpy.frombuffer(self.map, dtype='<u8', count=self.rows + 1, offset=offset)
+		self.strings = offset + 8 * (self.rows + 1)
+		self.attributes = [X['name'] for X in header['columns']]
+		self.values = dict((X['name'], X['values']) for X in header['columns'])
+
+	def covers(self, params):
+		return all(X in self.columns for X in params)
+
+	def mask(self, params):
+		mask = self.numpy.ones(self.rows, dtype=bool)
+		for attribute in params:
+			codes = [self.codes[attribute][X] for X in set(unicode(Y) for Y in params[attribute]) if X in self.codes[attribute]]
+			if len(codes) == 1:
+				mask &= self.columns[attribute] == codes[0]
+			else:
+				mask &= self.numpy.in1d(self.columns[attribute], codes)
+		return mask
+
+	def count(self, params):
+		return int(self.numpy.count_nonzero(self.mask(params)))
+
+	def locations(self, params):
+		res = []
+		for row in self.numpy.flatnonzero(self.mask(params)):
+			res.append(self.map[self.strings + int(self.offsets[row]):self.strings + int(self.offsets[row + 1])].decode('utf-8'))
+		return res
+
+	def attribute_values(self, attributes):
+		return dict((X, list(self.values[X])) for X in attributes)
+
+# Snapshots currently mapped, by file name, with the catalog version and file time they were loaded for
+snapshots = dict()
+snapshots_lock = threading.Lock()
+
+# Snapshot of the given catalog version, or None if it is missing, stale or cannot be read (e.g. without numpy)
+def load_snapshot(filename, version):
+	try:
+		stamp = (version, os.stat(filename).st_mtime)
+	except OSError:
+		stamp = (version, None)
+	with snapshots_lock:
+		if filename in snapshots and snapshots[filename][0] == stamp:
+			return snapshots[filename][1]
+		try:
+			snapshot = Snapshot(filename)
+		except (ImportError, IOError, OSError, ValueError, AssertionError):
+			snapshot = None
+		if snapshot is not None and snapshot.version != version:
+			snapshot = None
+		# Pages of a replaced snapshot are released once no reader holds on to it
+		snapshots[filename] = (stamp, snapshot)
+		return snapshot
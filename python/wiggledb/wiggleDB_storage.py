@@ -0,0 +1,84 @@
+# Copyright [1999-2016] EMBL-European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import sqlite3
+
+# Seconds a connection waits for another one to release its lock
+BUSY_TIMEOUT = 30
+# Number of times a transaction is rerun when the database is still locked after that
+LOCK_RETRIES = 5
+# Seconds before the first rerun, doubled each time
+RETRY_DELAY = 0.5
+# Prepared statements kept per connection
+CACHED_STATEMENTS = 256
+
+###########################################
+## Connections
+###########################################
+
+# All processes (CGI, query service, poller, worker, finish jobs and command line) connect through here
+def connect(db, check_same_thread=True):
+	conn = sqlite3.connect(db, timeout=BUSY_TIMEOUT, check_same_thread=check_same_thread, cached_statements=CACHED_STATEMENTS)
+	# Safe with a write-ahead log, which is synced at checkpoints
+	if conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+		conn.execute('PRAGMA synchronous=NORMAL')
+	return conn
+
+JOURNAL_MODES = ['DELETE', 'TRUNCATE', 'PERSIST', 'WAL']
+
+# With WAL, readers neither block nor are blocked by the writer, but all processes must run
+# on the same host. The mode is stored in the database file, so this is only done when
+# creating or upgrading it.
+def set_journal_mode(conn, mode):
+	assert mode.upper() in JOURNAL_MODES, 'Unknown journal mode %s, expected one of %s' % (mode, ", ".join(JOURNAL_MODES))
+	conn.commit()
+	return conn.execute('PRAGMA journal_mode=%s' % mode.upper()).fetchone()[0]
+
+# Takes the write lock at once rather than at the first write, so that what the
+# transaction reads still holds when it commits
+def begin_immediate(conn):
+	conn.commit()
+	conn.execute('BEGIN IMMEDIATE')
+
+def is_locked(error):
+	return isinstance(error, sqlite3.OperationalError) and ('locked' in str(error) or 'busy' in str(error))
+
+###########################################
+## Transactions
+###########################################
+
+# Runs function(cursor, *args) in its own transaction, rerun from scratch if the database stays locked.
+# Once it has written, the function must not wait on anything else than the database (e.g. subprocesses or e-mails).
+def transaction(conn, function, *args):
+	delay = RETRY_DELAY
+	for attempt in range(LOCK_RETRIES + 1):
+		try:
+			res = function(conn.cursor(), *args)
+			conn.commit()
+			return res
+		except Exception as error:
+			conn.rollback()
+			if not is_locked(error) or attempt == LOCK_RETRIES:
+				raise
+		time.sleep(delay)
+		delay *= 2
+
+# Same, on a connection of its own
+def run(db, function, *args):
+	conn = connect(db)
+	try:
+		return transaction(conn, function, *args)
+	finally:
+		conn.close()
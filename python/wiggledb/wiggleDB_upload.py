@@ -0,0 +1,117 @@
+# Copyright [1999-2016] EMBL-European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import os.path
+import hashlib
+import subprocess
+import multiprocessing.pool
+
+# Files uploaded at the same time
+UPLOAD_THREADS = 4
+# Parts of one file uploaded at the same time, and their size
+PART_THREADS = 8
+PART_SIZE = 16 * 1024 * 1024
+# Object metadata holding the MD5 of the content (multipart ETags are not content hashes)
+HASH_KEY = 'wiggledb-md5'
+CONTENT_TYPES = {'.png':'image/png', '.bw':'application/octet-stream', '.bb':'application/octet-stream'}
+
+class UploadError(Exception):
+	pass
+
+###########################################
+## Objects
+###########################################
+
+def content_hash(filename):
+	digest = hashlib.md5()
+	file = open(filename, 'rb')
+	for block in iter(lambda: file.read(1024 * 1024), ''):
+		digest.update(block)
+	file.close()
+	return digest.hexdigest()
+
+def object_key(filename):
+	return os.path.basename(filename)
+
+def content_type(filename):
+	return CONTENT_TYPES.get(os.path.splitext(filename)[1], 'text/plain')
+
+###########################################
+## Native uploads
+###########################################
+
+# None if boto3 is not installed
+def s3_client(config):
+	try:
+		import boto3
+	except ImportError:
+		return None
+	session = boto3.session.Session()
+	return session.client('s3', region_name=config.get('s3_region'), endpoint_url=config.get('s3_endpoint'))
+
+def remote_hash(client, bucket, key):
+	import botocore.exceptions
+	try:
+		return client.head_object(Bucket=bucket, Key=key)['Metadata'].get(HASH_KEY)
+	except botocore.exceptions.ClientError as error:
+		if error.response['Error']['Code'] in ['404', 'NoSuchKey', 'NotFound']:
+			return None
+		raise
+
+# Returns False if the bucket already had the same content under that key
+def upload_file(client, config, filename):
+	import boto3.s3.transfer
+	key = object_key(filename)
+	digest = content_hash(filename)
+	if remote_hash(client, config['s3_bucket'], key) == digest:
+		return False
+	transfer = boto3.s3.transfer.TransferConfig(multipart_threshold=PART_SIZE, multipart_chunksize=PART_SIZE, max_concurrency=PART_THREADS)
+	extra = {'ACL':'public-read', 'ContentType':content_type(filename), 'Metadata':{HASH_KEY:digest}}
+	client.upload_file(filename, config['s3_bucket'], key, ExtraArgs=extra, Config=transfer)
+	return True
+
+###########################################
+## AWS command line
+###########################################
+
+def upload_file_cli(config, filename):
+	cmd = "aws s3 cp %s s3://%s/%s --acl public-read" % (filename, config['s3_bucket'], object_key(filename))
+	if 's3_endpoint' in config:
+		cmd += " --endpoint-url %s" % config['s3_endpoint']
+	if subprocess.call(cmd, shell=True) != 0:
+		raise UploadError('Failed to copy over results:\n' + cmd)
+	return True
+
+###########################################
+## Uploads
+###########################################
+
+# Uploads all the files in parallel, returns for each whether it was actually transferred
+def upload_files(config, files):
+	if len(files) == 0:
+		return []
+	if 'aws_config' in config:
+		os.environ['AWS_CONFIG_FILE'] = config['aws_config']
+	client = s3_client(config)
+	if client is None:
+		upload = lambda X: upload_file_cli(config, X)
+	else:
+		# Clients, unlike sessions, can be shared between threads
+		upload = lambda X: upload_file(client, config, X)
+	pool = multiprocessing.pool.ThreadPool(min(UPLOAD_THREADS, len(files)))
+	try:
+		return pool.map(upload, files)
+	finally:
+		pool.close()
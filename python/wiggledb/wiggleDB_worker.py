@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+# Copyright [1999-2016] EMBL-European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import time
+import fcntl
+import argparse
+import subprocess
+import traceback
+import multiprocessing
+
+import wiggledb.wiggleDB
+import wiggledb.wiggleDB_storage
+
+def get_options():
+	parser = argparse.ArgumentParser(description='WiggleDB local batch worker.')
+	parser.add_argument('--config','-c',dest='config',help='Configuration file',required=True)
+	parser.add_argument('--workers','-n',dest='workers',help='Number of commands run in parallel',type=int)
+	parser.add_argument('--retries','-r',dest='retries',help='Number of times a failed command is rerun',type=int)
+	parser.add_argument('--interval','-i',dest='interval',help='Seconds between two looks at the queue',type=float,default=1)
+	parser.add_argument('--verbose','-v',dest='verbose',help='Turn on status output',action='store_true')
+	options = parser.parse_args()
+	config = wiggledb.wiggleDB.read_config_file(options.config)
+	if options.workers is None:
+		options.workers = int(config.get('local_workers', multiprocessing.cpu_count()))
+	if options.retries is None:
+		options.retries = int(config.get('local_retries', wiggledb.wiggleDB.LOCAL_RETRIES))
+	wiggledb.wiggleDB.verbose = options.verbose
+	return options, config
+
+def run_task(cmd):
+	return subprocess.call(cmd, shell=True)
+
+def collect_tasks(cursor, running, retries):
+	finished = [X for X in running if running[X].ready()]
+	for taskID in finished:
+		try:
+			return_code = running.pop(taskID).get()
+		except Exception:
+			traceback.print_exc()
+			return_code = -1
+		wiggledb.wiggleDB.finish_local_task(cursor, taskID, return_code, retries)
+	return len(finished)
+
+def start_tasks(conn, cursor, pool, running, workers):
+	tasks = wiggledb.wiggleDB.local_ready_tasks(cursor, workers - len(running))
+	claimed = [X for X in tasks if wiggledb.wiggleDB.claim_local_task(cursor, X[0])]
+	# Tasks are marked RUNNING before they reach the pool, so that they are not run twice
+	conn.commit()
+	for taskID, cmd in claimed:
+		if wiggledb.wiggleDB.verbose:
+			print cmd
+		running[taskID] = pool.apply_async(run_task, (cmd,))
+	return len(claimed)
+
+# Held as long as the worker runs: tasks left RUNNING at startup can only belong to a dead worker
+def lock_database(config):
+	lock = open(config['database_location'] + '.worker', 'w')
+	try:
+		fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except IOError:
+		sys.exit('Another worker is already running on %s' % config['database_location'])
+	return lock
+
+def main():
+	options, config = get_options()
+	lock = lock_database(config)
+	conn = wiggledb.wiggleDB_storage.connect(config['database_location'])
+	cursor = conn.cursor()
+	wiggledb.wiggleDB.requeue_local_tasks(cursor)
+	conn.commit()
+
+	pool = multiprocessing.Pool(options.workers)
+	poll = wiggledb.wiggleDB.batch_system_poller('LOCAL')
+	running = dict()
+	while True:
+		try:
+			changes = collect_tasks(cursor, running, options.retries)
+			if changes > 0:
+				wiggledb.wiggleDB.update_job_statuses(cursor, poll)
+			conn.commit()
+			# Finished jobs make room for queued ones
+			wiggledb.wiggleDB.dispatch_queued_jobs(conn, cursor, config, 'LOCAL')
+			if start_tasks(conn, cursor, pool, running, options.workers) > 0:
+				continue
+		except Exception:
+			conn.rollback()
+			traceback.print_exc()
+		time.sleep(options.interval)
+
+if __name__ == "__main__":
+	main()